@@ -0,0 +1,206 @@
+from datetime import datetime, timedelta
+import argparse
+import asyncio
+import httpx
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# End-to-end load test of /fetch-and-transform and /export against the local upstream
+# stand-in. Starts mock_upstream.py and the backend (uvicorn main:app) with a fresh store,
+# then reports per endpoint the latency of the first (cold) request and, for the
+# following requests, the throughput and p50/p99 latency, plus the peak memory of the
+# backend processes so far. Run from anywhere:
+#
+#     python benchmarks/load.py --records 20000 --latency 0.05 --concurrency 8 --requests 50
+#
+# --workers and --cpu-workers run the backend in its multi-worker mode, to compare the
+# throughput across core counts.
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.dirname(BENCHMARKS_DIR)
+
+
+def start_process(arguments: list, cwd: str, env: dict):
+    return subprocess.Popen(
+        arguments, cwd=cwd, env={**os.environ, **env}, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+    )
+
+
+def wait_until_up(url: str, process: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited: {process.stderr.read().decode()}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.TransportError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not start within {timeout}s")
+
+
+# A process and all of its descendants (uvicorn workers, pool processes), from /proc
+def process_tree(pid: int):
+    pids = [pid]
+    try:
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as children:
+                for child in children.read().split():
+                    pids.extend(process_tree(int(child)))
+    except OSError:
+        pass
+    return pids
+
+
+# Peak resident memory of a process and its descendants in MiB, summed, from /proc
+# (Linux only)
+def peak_memory(pid: int):
+    total = None
+    for process in process_tree(pid):
+        try:
+            with open(f"/proc/{process}/status") as status:
+                for line in status:
+                    if line.startswith("VmHWM:"):
+                        total = (total or 0) + int(line.split()[1]) / 1024
+        except OSError:
+            pass
+    return total
+
+
+def percentile(values: list, fraction: float):
+    ordered = sorted(values)
+    return ordered[min(int(fraction * len(ordered)), len(ordered) - 1)]
+
+
+async def run_load(client: httpx.AsyncClient, urls: list, requests: int, concurrency: int):
+    latencies, failures, received = [], 0, 0
+    next_request = iter(range(requests))
+
+    async def worker():
+        nonlocal failures, received
+        for index in next_request:
+            started = time.perf_counter()
+            response = await client.get(urls[index % len(urls)])
+            latencies.append(time.perf_counter() - started)
+            received += len(response.content)
+            if response.status_code != 200:
+                failures += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    return {
+        "requests": len(latencies),
+        "failures": failures,
+        "seconds": elapsed,
+        "throughput": len(latencies) / elapsed,
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "bytes_per_request": received / len(latencies),
+    }
+
+
+async def benchmark(base_url: str, endpoint: str, query: str, devices: list, args, pid: int):
+    urls = [f"{base_url}{endpoint}?device_serial_number={device}&{query}" for device in devices]
+    async with httpx.AsyncClient(timeout=600) as client:
+        # The first request of each device pages the upstream into the store
+        cold = []
+        for url in urls:
+            started = time.perf_counter()
+            response = await client.get(url)
+            response.raise_for_status()
+            cold.append(time.perf_counter() - started)
+
+        result = await run_load(client, urls, args.requests, args.concurrency)
+    return {"endpoint": endpoint, "cold_ms": statistics.mean(cold) * 1000, **result, "peak_memory_mib": peak_memory(pid)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of /fetch-and-transform and /export")
+    parser.add_argument("--records", type=int, default=20000, help="records per device in the stand-in")
+    parser.add_argument("--interval", type=int, default=60, help="seconds between generated records")
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds the stand-in waits per page")
+    parser.add_argument("--devices", type=int, default=1, help="distinct devices requested in turn")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=50, help="requests per endpoint after the cold one")
+    parser.add_argument("--max-pages", type=int, default=50)
+    parser.add_argument("--format", default="records", help="format of /fetch-and-transform")
+    parser.add_argument("--file-format", default="csv", help="file_format of /export")
+    parser.add_argument("--endpoints", default="fetch-and-transform,export")
+    parser.add_argument("--result-cache-ttl", default="0", help="RESULT_CACHE_TTL of the backend")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn worker processes (sets MULTI_WORKER above 1)")
+    parser.add_argument("--cpu-workers", type=int, default=0, help="CPU_WORKERS of each backend worker")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--upstream-port", type=int, default=9100)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    end = datetime.fromisoformat(os.getenv("MOCK_END", "2024-11-08T12:00:00+00:00"))
+    start = end - timedelta(seconds=args.interval * (args.records - 1))
+    dates = f"start_date={start.date().isoformat()}&end_date={end.date().isoformat()}&max_pages={args.max_pages}"
+    queries = {
+        "fetch-and-transform": f"{dates}&format={args.format}",
+        "export": f"{dates}&file_format={args.file_format}",
+    }
+    devices = [f"BENCH{index:06d}" for index in range(args.devices)]
+
+    store_dir = tempfile.TemporaryDirectory()
+    upstream = start_process(
+        [sys.executable, "mock_upstream.py", "--port", str(args.upstream_port)], BENCHMARKS_DIR,
+        {"MOCK_RECORDS": str(args.records), "MOCK_INTERVAL": str(args.interval), "MOCK_LATENCY": str(args.latency)},
+    )
+    backend = start_process(
+        [
+            sys.executable, "-m", "uvicorn", "main:app", "--port", str(args.port), "--workers", str(args.workers),
+            "--log-level", "warning",
+        ],
+        BACKEND_DIR,
+        {
+            "API_URL": f"http://127.0.0.1:{args.upstream_port}/",
+            "STORE_PATH": os.path.join(store_dir.name, "records.db"),
+            "RESULT_CACHE_TTL": args.result_cache_ttl,
+            "MULTI_WORKER": str(args.workers > 1).lower(),
+            "CPU_WORKERS": str(args.cpu_workers),
+        },
+    )
+    try:
+        wait_until_up(f"http://127.0.0.1:{args.upstream_port}/stats", upstream)
+        wait_until_up(f"http://127.0.0.1:{args.port}/docs", backend)
+
+        results = []
+        for endpoint in args.endpoints.split(","):
+            results.append(asyncio.run(benchmark(
+                f"http://127.0.0.1:{args.port}", f"/{endpoint}", queries[endpoint], devices, args, backend.pid)))
+        upstream_stats = httpx.get(f"http://127.0.0.1:{args.upstream_port}/stats").json()
+    finally:
+        backend.terminate()
+        upstream.terminate()
+        backend.wait()
+        upstream.wait()
+        store_dir.cleanup()
+
+    if args.json:
+        print(json.dumps({"arguments": vars(args), "results": results, "upstream": upstream_stats}, indent=2))
+        return
+
+    print(
+        f"{args.records} records per device, {args.devices} device(s), {args.latency}s upstream latency, "
+        f"{args.concurrency} concurrent clients, {args.requests} requests per endpoint, "
+        f"{args.workers} worker(s) with {args.cpu_workers} CPU worker(s) each")
+    print(f"{'endpoint':<22}{'cold ms':>10}{'req/s':>9}{'p50 ms':>10}{'p99 ms':>10}{'failed':>8}{'peak MiB':>10}")
+    for result in results:
+        memory = f"{result['peak_memory_mib']:.0f}" if result["peak_memory_mib"] is not None else "n/a"
+        print(
+            f"{result['endpoint']:<22}{result['cold_ms']:>10.0f}{result['throughput']:>9.1f}{result['p50_ms']:>10.0f}"
+            f"{result['p99_ms']:>10.0f}{result['failures']:>8}{memory:>10}")
+    print(f"upstream: {upstream_stats['requests']} requests, {upstream_stats['records']} records")
+
+
+if __name__ == "__main__":
+    main()
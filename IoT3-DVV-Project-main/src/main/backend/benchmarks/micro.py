@@ -0,0 +1,144 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+# Microbenchmarks of the per-request hot paths on generated records, without the
+# network. The exports read the records from a temporary store. Run from anywhere:
+#
+#     python benchmarks/micro.py --records 20000 --repeat 5
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+# The configuration files are read relative to the working directory
+os.chdir(BACKEND_DIR)
+
+from mock_upstream import make_record  # noqa: E402
+import config  # noqa: E402
+import store  # noqa: E402
+from calibration import scale_values, scale_frame, get_plan  # noqa: E402
+from export import export_data  # noqa: E402
+from frames import concat_frames, frame_from_records  # noqa: E402
+from timestamps import parse_timestamps  # noqa: E402
+from transform import transform_data, transform_columnar  # noqa: E402
+
+
+# Records as fetch_data returns them: newest first, with the parsed epoch
+def make_records(device_serial_number: str, count: int):
+    records = [make_record(device_serial_number, index) for index in range(count)]
+    epochs = parse_timestamps([record["created_at"] for record in records]).tolist()
+    for record, epoch in zip(records, epochs):
+        record["epoch"] = epoch
+    return records
+
+
+def pages_of(records: list, page_size: int = 1000):
+    return [records[start:start + page_size] for start in range(0, len(records), page_size)]
+
+
+async def consume(response):
+    size = 0
+    async for chunk in response.body_iterator:
+        size += len(chunk)
+    return size
+
+
+# Store the records as a sync would, and return the window that holds them all
+def store_records(records: list, device_serial_number: str):
+    store.add_records(device_serial_number, [
+        (record["epoch"], record["created_at"], json.dumps({key: value for key, value in record.items() if key != "epoch"}))
+        for record in records
+    ])
+    return records[-1]["epoch"], records[0]["epoch"] + 1
+
+
+def run_export(window: tuple, file_format: str, plan, device_serial_number: str):
+    async def export():
+        response = await export_data(window, file_format, plan, device_serial_number)
+        return await consume(response)
+    return asyncio.run(export())
+
+
+def scale_records(records: list, device_serial_number: str, scaling_factors: dict):
+    return [scale_values(device_serial_number, record.get("property", {}), scaling_factors) for record in records]
+
+
+# Records as render_device_data reads them: one frame built page by page
+def frame_records(records: list):
+    return concat_frames([frame_from_records(page) for page in pages_of(records)])
+
+
+def measure(name: str, function, repeat: int, records: int):
+    function()  # warm up
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        timings.append(time.perf_counter() - started)
+    best = min(timings)
+    return {
+        "name": name,
+        "best_ms": best * 1000,
+        "mean_ms": statistics.mean(timings) * 1000,
+        "records_per_second": records / best if best else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Microbenchmarks of calibration, transformation and export")
+    parser.add_argument("--records", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--device", default="WR2009000663", help="device whose calibration is applied")
+    parser.add_argument("--formats", default="csv,json,ndjson,parquet", help="export formats to measure")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    store_dir = tempfile.TemporaryDirectory()
+    os.environ["STORE_PATH"] = os.path.join(store_dir.name, "records.db")
+
+    settings = config.current()
+    plan = get_plan(args.device, settings.calibration_plans)
+    records = make_records(args.device, args.records)
+    frame = frame_records(records)
+    scaled_frame = scale_frame(plan, frame)
+    window = store_records(records, args.device)
+
+    benchmarks = [
+        ("scale_values", lambda: scale_records(records, args.device, settings.scaling_factors)),
+        ("frame_from_records", lambda: frame_records(records)),
+        ("scale_frame", lambda: scale_frame(plan, frame)),
+        ("transform_data", lambda: transform_data(scaled_frame, settings.units)),
+        ("transform_columnar", lambda: transform_columnar(scaled_frame, units=settings.units)),
+    ]
+    for file_format in args.formats.split(","):
+        if file_format in ("parquet", "arrow"):
+            try:
+                import pyarrow  # noqa: F401
+            except ImportError:
+                print(f"Skipping export_data[{file_format}]: pyarrow is not installed", file=sys.stderr)
+                continue
+        benchmarks.append((
+            f"export_data[{file_format}]",
+            lambda file_format=file_format: run_export(window, file_format, plan, args.device),
+        ))
+
+    results = [measure(name, function, args.repeat, args.records) for name, function in benchmarks]
+
+    if args.json:
+        print(json.dumps({"records": args.records, "repeat": args.repeat, "results": results}, indent=2))
+        return
+
+    print(f"{args.records} records, best of {args.repeat}")
+    print(f"{'benchmark':<24}{'best ms':>12}{'mean ms':>12}{'records/s':>14}")
+    for result in results:
+        print(
+            f"{result['name']:<24}{result['best_ms']:>12.2f}{result['mean_ms']:>12.2f}"
+            f"{result['records_per_second']:>14,.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+from datetime import datetime, timedelta, timezone
+from fastapi import FastAPI, Request
+from fastapi.responses import Response
+from functools import lru_cache
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+
+# Local stand-in for the upstream API at API_URL.
+#
+# Answers the same POST body as extract.make_api_request with a
+# {"response": {"Payload": [...records, {"page_token": ...}]}} page, newest record
+# first, and a page_token of {"offset": n} while older records remain. Every device has
+# MOCK_RECORDS deterministic records, one every MOCK_INTERVAL seconds up to MOCK_END, and
+# each request waits MOCK_LATENCY seconds before it is answered.
+
+MOCK_RECORDS = int(os.getenv("MOCK_RECORDS", "20000"))
+MOCK_INTERVAL = int(os.getenv("MOCK_INTERVAL", "60"))
+MOCK_LATENCY = float(os.getenv("MOCK_LATENCY", "0.05"))
+MOCK_END = datetime.fromisoformat(os.getenv("MOCK_END", "2024-11-08T12:00:00+00:00"))
+
+app = FastAPI()
+
+# Requests served, see GET /stats
+stats = {"requests": 0, "records": 0}
+
+
+# The record `index` steps older than the newest record of a device
+def make_record(device_serial_number: str, index: int):
+    created_at = MOCK_END - timedelta(seconds=MOCK_INTERVAL * index)
+    noise = random.Random(f"{device_serial_number}-{index}")
+    wave = math.sin(index / 240)
+    return {
+        "created_at": created_at.astimezone(timezone.utc).isoformat(),
+        "serialNumber": device_serial_number,
+        "property": {
+            "V1_Voltage": 228 + 6 * wave + noise.random(),
+            "V2_Voltage": 229 + 6 * wave + noise.random(),
+            "V3_Voltage": 227 + 6 * wave + noise.random(),
+            "I1_Current": 12 + 4 * wave + noise.random(),
+            "I2_Current": 11 + 4 * wave + noise.random(),
+            "I3_Current": 13 + 4 * wave + noise.random(),
+            "KW_L1": 2.6 + wave, "KW_L2": 2.5 + wave, "KW_L3": 2.9 + wave,
+            "Kvar_L1": 0.4, "Kvar_L2": 0.5, "Kvar_L3": 0.3,
+            "KVA_L1": 2.7 + wave, "KVA_L2": 2.6 + wave, "KVA_L3": 3.0 + wave,
+            "PF_L1": 0.96, "PF_L2": 0.95, "PF_L3": 0.97,
+            "Total_KW": 8.0 + 3 * wave, "Total_Kvar": 1.2, "Total_KVA": 8.3 + 3 * wave, "Total_PF": 0.96,
+            "Kwh_Import": round(250000 - index * 0.13, 2),
+            "KVAh_import": round(260000 - index * 0.14, 2),
+            "Frequency": 50 + noise.random() / 10,
+            "rssi": -67, "rsrp": -95, "rsrq": -11,
+            "act": "LTE", "lte_rx": 120, "lte_tx": 80, "lte_bytes": 200,
+            "modelname": "EM-3P", "devicename": device_serial_number, "version": "1.0.0",
+            "mac address": "00:11:22:33:44:55", "serial number": device_serial_number,
+            "IPADD": "10.0.0.2", "wwan_ip": "10.64.0.2", "status": "online",
+        },
+    }
+
+
+# Encoded pages are cached so that the stand-in itself stays cheap next to the backend
+@lru_cache(maxsize=1024)
+def page_body(device_serial_number: str, offset: int, page_size: int):
+    end = min(offset + page_size, MOCK_RECORDS)
+    records = [make_record(device_serial_number, index) for index in range(offset, end)]
+    page_token = {"offset": end} if end < MOCK_RECORDS else None
+    return json.dumps({"response": {"Payload": records + [{"page_token": page_token}]}}).encode()
+
+
+@app.post("/")
+async def page(request: Request):
+    body = await request.json()
+    await asyncio.sleep(MOCK_LATENCY)
+
+    offset = (body.get("page_token") or {}).get("offset", 0)
+    page_size = body.get("data_per_page", 1000)
+    stats["requests"] += 1
+    stats["records"] += max(min(page_size, MOCK_RECORDS - offset), 0)
+    return Response(page_body(body["deviceSerialNumber"], offset, page_size), media_type="application/json")
+
+
+@app.get("/stats")
+async def get_stats():
+    return stats
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the upstream API")
+    parser.add_argument("--port", type=int, default=9100)
+    args = parser.parse_args()
+    uvicorn.run(app, port=args.port, log_level="warning")
@@ -1,4 +1,8 @@
 import json
+import numpy as np
+from typing import NamedTuple
+import metrics
+from frames import FRAME_COLUMNS, RecordFrame, frame_length, frame_matrix, with_values
 
 
 def load_scaling_factors(filename: str):
@@ -46,3 +50,71 @@ def scale_values(device_serial: str, properties: dict, scaling_factors: dict):
             scaled_properties[key] = value
 
     return scaled_properties
+
+
+# Calibration of one device compiled for batched use: the calibrated property keys
+# and, per key, the divisor, multiplier and offset that reproduce its operation
+class CalibrationPlan(NamedTuple):
+    keys: list
+    divisors: np.ndarray
+    multipliers: np.ndarray
+    offsets: np.ndarray
+
+
+def compile_plan(device_serial: str, scaling_factors: dict):
+    keys, divisors, multipliers, offsets = [], [], [], []
+
+    for key, device_scaling in scaling_factors.get(device_serial, {}).items():
+        if not device_scaling:
+            continue
+
+        scaling_factor = device_scaling.get("value", 1)
+        operation_name = device_scaling.get("operation")
+        divisor, multiplier, offset = 1.0, 1.0, 0.0
+
+        if operation_name == "division":
+            # Division by zero yields 0, like divide()
+            if scaling_factor != 0:
+                divisor = scaling_factor
+            else:
+                multiplier = 0.0
+        elif operation_name == "multiplication":
+            multiplier = scaling_factor
+        elif operation_name == "addition":
+            offset = scaling_factor
+
+        keys.append(key)
+        divisors.append(divisor)
+        multipliers.append(multiplier)
+        offsets.append(offset)
+
+    return CalibrationPlan(
+        keys,
+        np.array(divisors, dtype=float),
+        np.array(multipliers, dtype=float),
+        np.array(offsets, dtype=float),
+    )
+
+
+# Compile the plans of every device in calibration.json
+def compile_scaling_factors(scaling_factors: dict):
+    return {device_serial: compile_plan(device_serial, scaling_factors) for device_serial in scaling_factors}
+
+
+def get_plan(device_serial: str, plans: dict):
+    return plans.get(device_serial) or compile_plan(device_serial, {})
+
+
+# Apply a plan to the columns of a record frame in one batched NumPy pass and return a
+# new frame. Missing values stay missing, and keys the frame does not keep are skipped.
+@metrics.timed("calibrate")
+def scale_frame(plan: CalibrationPlan, frame: RecordFrame):
+    columns = [column for column, key in enumerate(plan.keys) if key in FRAME_COLUMNS]
+    if not columns or not frame_length(frame):
+        return frame
+
+    keys = [plan.keys[column] for column in columns]
+    scaled_values = (
+        frame_matrix(frame, keys) / plan.divisors[columns] * plan.multipliers[columns] + plan.offsets[columns]
+    )
+    return with_values(frame, keys, scaled_values)
@@ -0,0 +1,100 @@
+import asyncio
+import os
+import pickle
+import store
+import time
+from collections import OrderedDict
+
+# Seconds a computed result is served again for an identical request (0 disables the
+# cache, leaving only the coalescing of concurrent requests)
+RESULT_CACHE_TTL = float(os.getenv("RESULT_CACHE_TTL", "5"))
+# Results kept per cache; the least recently used one is evicted first
+RESULT_CACHE_SIZE = int(os.getenv("RESULT_CACHE_SIZE", "32"))
+# Bytes the results of a cache may hold in total, as measured by its size function
+RESULT_CACHE_BYTES = int(os.getenv("RESULT_CACHE_BYTES", str(64 * 1024 * 1024)))
+
+
+# Single-flight result cache. Concurrent calls with the same key await one shared
+# computation, and its result is then kept for ttl seconds in an LRU bounded by entries
+# and by bytes (as measured by size; a result larger than max_bytes is not kept).
+# Expired results are dropped on every get and finish. Failures are not cached: every
+# caller waiting on a failed computation gets its exception, and the next call computes
+# again. Callers share the result object, so they must not modify it.
+#
+# With `shared` set, results are also kept in the store under that name for ttl seconds
+# (pickled, keyed by the repr of the key), so the other worker processes on the same
+# store reuse them too. The store is read and written off the event loop (see store.run).
+class ResultCache:
+    def __init__(
+            self, ttl: float = RESULT_CACHE_TTL, max_entries: int = RESULT_CACHE_SIZE,
+            max_bytes: int = RESULT_CACHE_BYTES, size=None, shared: str = None):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.size = size or (lambda result: 0)
+        self.shared = shared
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.in_flight = {}
+
+    async def get(self, key, compute):
+        self.purge()
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+            return entry[1]
+
+        future = self.in_flight.get(key)
+        if future is None:
+            if self.shared and self.ttl > 0:
+                compute = self.shared_compute(key, compute)
+            future = asyncio.ensure_future(compute())
+            self.in_flight[key] = future
+            future.add_done_callback(lambda done: self.finish(key, done))
+
+        # A caller that goes away (e.g. a closed connection) must not cancel the
+        # computation the other callers are waiting on
+        return await asyncio.shield(future)
+
+    # Wrap compute to look the result up in the store first, and to store what it computes
+    def shared_compute(self, key, compute):
+        async def compute_shared():
+            value = await store.run(store.get_result, self.shared, repr(key))
+            if value is not None:
+                return pickle.loads(value)
+            result = await compute()
+            await store.run(
+                store.add_result, self.shared, repr(key), pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL),
+                time.time() + self.ttl)
+            return result
+        return compute_shared
+
+    def finish(self, key, future: asyncio.Future):
+        if self.in_flight.get(key) is future:
+            del self.in_flight[key]
+        if future.cancelled() or future.exception() is not None or self.ttl <= 0 or self.max_entries <= 0:
+            return
+
+        self.purge()
+        result = future.result()
+        size = self.size(result)
+        if size > self.max_bytes:
+            return
+
+        self.evict(key)
+        self.entries[key] = (time.monotonic() + self.ttl, result, size)
+        self.bytes += size
+        while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+            self.evict(next(iter(self.entries)))
+
+    def evict(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.bytes -= entry[2]
+
+    # Drop the expired results. Hits move results to the end, so they are not in the
+    # order they expire in, but a cache holds few enough of them to check them all.
+    def purge(self):
+        now = time.monotonic()
+        for key in [key for key, (expires, _, _) in self.entries.items() if expires <= now]:
+            self.evict(key)
@@ -0,0 +1,136 @@
+import asyncio
+import json
+import logging
+import os
+from typing import NamedTuple
+from calibration import load_scaling_factors, compile_scaling_factors
+from thresholds import ThresholdPlan, compile_thresholds
+
+# Registry of the configuration files: calibration.json, thresholds.json and units.json.
+#
+# The files are loaded and compiled once into a Config snapshot. A background task
+# checks their modification times every CONFIG_RELOAD_INTERVAL seconds and, when one
+# changed, builds a new snapshot and swaps it in as a whole, so requests never read the
+# files themselves and always see one consistent set of settings.
+
+CALIBRATION_FILE = "calibration.json"
+THRESHOLDS_FILE = "thresholds.json"
+UNITS_FILE = "units.json"
+
+# Seconds between checks for changed configuration files (0 disables reloading)
+CONFIG_RELOAD_INTERVAL = float(os.getenv("CONFIG_RELOAD_INTERVAL", "5"))
+
+logger = logging.getLogger(__name__)
+
+
+class Config(NamedTuple):
+    scaling_factors: dict
+    calibration_plans: dict
+    thresholds: dict
+    threshold_plan: ThresholdPlan
+    units: dict
+    mtimes: tuple
+
+
+# Load threshold values from thresholds.json
+def load_threshold_values(filename: str):
+    """Load threshold values from a JSON file."""
+    with open(filename, 'r') as file:
+        return json.load(file)
+
+
+# Load units configuration from a JSON file
+def load_units_config(config_path: str):
+    try:
+        with open(config_path, "r") as file:
+            return json.load(file)
+    except Exception as e:
+        print(f"Error loading units configuration: {e}")
+        return {}
+
+
+# Units of every series, with the defaults filled in
+def compile_units(units_config: dict):
+    return {
+        "voltage": units_config.get("voltage", "Volts"),
+        "current": units_config.get("current", "Ampere"),
+        "power": {
+            "KW": units_config.get("power", {}).get("KW", "kW"),
+            "Kvar": units_config.get("power", {}).get("Kvar", "kVar"),
+            "KVA": units_config.get("power", {}).get("KVA", "kVA"),
+            "PF": units_config.get("power", {}).get("PF", "%"),
+        },
+        "energy": units_config.get("energy", "kWh"),
+        "frequency": units_config.get("frequency", "Hz"),
+    }
+
+
+def file_mtimes():
+    return tuple(
+        os.stat(filename).st_mtime_ns if os.path.exists(filename) else None
+        for filename in (CALIBRATION_FILE, THRESHOLDS_FILE, UNITS_FILE)
+    )
+
+
+def load_config():
+    mtimes = file_mtimes()
+    scaling_factors = load_scaling_factors(CALIBRATION_FILE)
+    thresholds = load_threshold_values(THRESHOLDS_FILE)
+    return Config(
+        scaling_factors=scaling_factors,
+        calibration_plans=compile_scaling_factors(scaling_factors),
+        thresholds=thresholds,
+        threshold_plan=compile_thresholds(thresholds),
+        units=compile_units(load_units_config(UNITS_FILE)),
+        mtimes=mtimes,
+    )
+
+
+_config = None
+
+
+# The current configuration snapshot. Read it once per request and use that snapshot
+# throughout, so a reload in between cannot mix old and new settings.
+def current():
+    global _config
+    if _config is None:
+        _config = load_config()
+    return _config
+
+
+# Swap in a freshly loaded snapshot if a file changed since the current one was loaded.
+# A file that fails to load (e.g. while it is being written) keeps the current snapshot.
+def reload():
+    global _config
+    if _config is not None and file_mtimes() == _config.mtimes:
+        return False
+    try:
+        _config = load_config()
+    except Exception as e:
+        logger.error(f"Keeping the current configuration, reload failed: {str(e)}")
+        return False
+    logger.info("Configuration reloaded")
+    return True
+
+
+async def watch():
+    while True:
+        await asyncio.sleep(CONFIG_RELOAD_INTERVAL)
+        reload()
+
+
+_watcher = None
+
+
+def start_watcher():
+    global _watcher
+    current()
+    if CONFIG_RELOAD_INTERVAL > 0 and _watcher is None:
+        _watcher = asyncio.create_task(watch())
+
+
+def stop_watcher():
+    global _watcher
+    if _watcher is not None:
+        _watcher.cancel()
+        _watcher = None
@@ -0,0 +1,138 @@
+import math
+import numpy as np
+from frames import RecordFrame, frame_length, frame_matrix, reverse_frame, take_rows, to_list, with_values
+from timestamps import epoch_to_iso
+
+# Numeric properties that are aggregated or downsampled per channel
+CHANNELS = [
+    "V1_Voltage", "V2_Voltage", "V3_Voltage",
+    "I1_Current", "I2_Current", "I3_Current",
+    "KW_L1", "KW_L2", "KW_L3",
+    "Kvar_L1", "Kvar_L2", "Kvar_L3",
+    "KVA_L1", "KVA_L2", "KVA_L3",
+    "PF_L1", "PF_L2", "PF_L3",
+    "Total_Kvar", "Total_KVA", "Total_PF",
+    "Kwh_Import", "KVAh_import", "Frequency",
+    "rssi", "rsrp", "rsrq",
+]
+
+
+# Build a frame of one row per bucket from the base rows of a frame, with the given
+# channel values and optionally the bucket start epochs as timestamps
+def bucket_frame(frame: RecordFrame, rows, values: np.ndarray, epochs: np.ndarray = None):
+    bucketed = with_values(take_rows(frame, rows), CHANNELS, values)
+    if epochs is not None:
+        bucketed = bucketed._replace(
+            epochs=epochs.astype(np.int64),
+            created_at=np.array([epoch_to_iso(epoch).encode() for epoch in epochs.tolist()], dtype=bytes),
+        )
+    return bucketed
+
+
+# Aggregate sorted samples into time buckets of bucket_ms milliseconds, returning a frame
+# of one row per bucket with the channel means, plus the per-bucket min and max of the
+# given channels
+def aggregate_buckets(frame: RecordFrame, bucket_ms: int, aligned: bool, minmax_channels: list = ()):
+    epochs = frame.epochs
+    origin = 0 if aligned else epochs[0]
+    bucket_ids = (epochs - origin) // bucket_ms
+    starts = np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]])
+
+    values = frame_matrix(frame, CHANNELS)
+    present = ~np.isnan(values)
+    counts = np.add.reduceat(present, starts, axis=0)
+    sums = np.add.reduceat(np.where(present, values, 0.0), starts, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(counts > 0, sums / counts, np.nan)
+
+    bucket_starts = origin + bucket_ids[starts] * bucket_ms
+    aggregated = bucket_frame(frame, starts, means, bucket_starts)
+
+    channels = [column for column, key in enumerate(CHANNELS) if key in minmax_channels and present[:, column].any()]
+    minimums = np.fmin.reduceat(values[:, channels], starts, axis=0)
+    maximums = np.fmax.reduceat(values[:, channels], starts, axis=0)
+    summary = {
+        "min": {CHANNELS[column]: to_list(minimums[::-1, index]) for index, column in enumerate(channels)},
+        "max": {CHANNELS[column]: to_list(maximums[::-1, index]) for index, column in enumerate(channels)},
+    }
+    return aggregated, summary
+
+
+# Largest-Triangle-Three-Buckets selection over every channel at once: one sample is
+# picked per bucket, the one whose triangles summed over the channels are largest. The
+# channels are scaled to their range first, so each weighs the same whatever its unit.
+# Returns the n_out selected sample indices.
+def lttb_indices(x: np.ndarray, y: np.ndarray, n_out: int):
+    n = len(y)
+    every = (n - 2) / (n_out - 2)
+    low = np.fmin.reduce(y, axis=0)
+    spread = np.fmax.reduce(y, axis=0) - low
+    y = (y - low) / np.where(spread > 0, spread, 1.0)
+
+    selected = np.zeros(n_out, dtype=np.int64)
+    selected[-1] = n - 1
+    a = 0
+
+    for bucket in range(n_out - 2):
+        start = int(math.floor(bucket * every)) + 1
+        end = int(math.floor((bucket + 1) * every)) + 1
+        next_end = min(int(math.floor((bucket + 2) * every)) + 1, n)
+
+        # Average point of the next bucket
+        next_y = y[end:next_end]
+        next_present = ~np.isnan(next_y)
+        with np.errstate(invalid="ignore", divide="ignore"):
+            avg_y = np.where(next_present, next_y, 0.0).sum(axis=0) / next_present.sum(axis=0)
+        avg_x = x[end:next_end].mean()
+
+        xa = x[a]
+        ya = y[a]
+        area = np.abs((xa - avg_x) * (y[start:end] - ya) - (xa - x[start:end, None]) * (avg_y - ya))
+        a = start + int(np.argmax(np.nansum(area, axis=1)))
+        selected[bucket + 1] = a
+
+    return selected
+
+
+# Downsample a calibrated record frame (newest first) to at most max_points rows, or to
+# one row per resolution seconds. "minmax" returns the per-bucket mean as rows plus the
+# per-bucket min/max of the channels in minmax_channels; "lttb" keeps the visually most significant record of
+# each bucket, with all of its channels. Returns (frame, summary), both newest first.
+def downsample_frame(
+        frame: RecordFrame, max_points: int = None, resolution: int = None, mode: str = "minmax",
+        minmax_channels: list = ()):
+    source_points = frame_length(frame)
+    if source_points < 3 or not (max_points or resolution) or (not resolution and source_points <= max_points):
+        return frame, None
+
+    # Work in chronological order
+    ordered = reverse_frame(frame)
+    epochs = ordered.epochs
+    span = int(epochs[-1] - epochs[0])
+
+    if mode == "lttb":
+        n_out = max_points or span // (resolution * 1000) + 1
+        if max_points and resolution:
+            n_out = min(n_out, span // (resolution * 1000) + 1)
+        if source_points <= n_out or n_out < 3:
+            return frame, None
+
+        x = (epochs - epochs[0]) / 1000.0
+        y = frame_matrix(ordered, CHANNELS)
+        downsampled = take_rows(ordered, lttb_indices(x, y, n_out))
+        summary = {}
+    else:
+        # Buckets of `resolution` are aligned to whole multiples of it, unless max_points
+        # needs wider buckets. Aligned buckets may straddle both ends of the range, so they
+        # are widened by whole resolutions until at most max_points of them remain.
+        bucket_ms = span // max_points + 1 if max_points else 0
+        aligned = bool(resolution) and resolution * 1000 >= bucket_ms
+        if aligned:
+            bucket_ms = resolution * 1000
+            while max_points and epochs[-1] // bucket_ms - epochs[0] // bucket_ms + 1 > max_points:
+                bucket_ms += resolution * 1000
+        downsampled, summary = aggregate_buckets(ordered, bucket_ms, aligned, minmax_channels)
+        summary["bucket_seconds"] = bucket_ms / 1000
+
+    summary.update({"mode": mode, "points": frame_length(downsampled), "source_points": source_points})
+    return reverse_frame(downsampled), summary
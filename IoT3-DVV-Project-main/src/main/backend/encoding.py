@@ -0,0 +1,91 @@
+from fastapi import HTTPException
+import json
+import metrics
+import pydantic_core
+from export import import_pyarrow
+from frames import read_frame
+from transform import flatten_columns, transform_frame
+
+# Media types of the encodings of a /fetch-and-transform response
+MEDIA_TYPES = {
+    "json": "application/json",
+    "msgpack": "application/msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+}
+
+
+def import_msgpack():
+    try:
+        import msgpack
+    except ImportError:
+        raise HTTPException(status_code=501, detail="MessagePack responses need the 'msgpack' package")
+    return msgpack
+
+
+# Check on the event loop that the package an encoding needs is installed; the error
+# could not be sent back from the process pool
+def require_encoding(encoding: str):
+    if encoding == "msgpack":
+        import_msgpack()
+    elif encoding == "arrow":
+        import_pyarrow()
+
+
+# Encode a response as JSON, byte for byte like FastAPI encodes a response_model (with
+# pydantic, which writes NaN and infinities as null)
+def encode_json(payload):
+    return pydantic_core.to_json(payload)
+
+
+# Encode a response as one line of newline-delimited JSON (without the newline)
+def encode_ndjson(payload: dict):
+    return json.dumps(payload).encode("utf-8")
+
+
+# Encode a columnar /fetch-and-transform response as MessagePack
+def encode_msgpack(payload: dict):
+    return import_msgpack().packb(payload)
+
+
+# Encode a columnar /fetch-and-transform response as an Arrow IPC stream. The series
+# become columns named by their path ("voltage.V1", "power.KW.L1", ...); units and the
+# other response fields are stored as JSON in the schema metadata.
+def encode_arrow(payload: dict):
+    pa = import_pyarrow()
+    columns = payload["mapped_data"]
+    metadata = {name: json.dumps(value) for name, value in payload.items() if name != "mapped_data"}
+    metadata["units"] = json.dumps(columns["units"])
+
+    table = pa.table(flatten_columns(columns)).replace_schema_metadata(metadata)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+
+    return sink.getvalue().to_pybytes()
+
+
+# JSON object of the given already encoded values, as encode_json encodes the object of
+# the decoded values
+def join_json(fields: dict):
+    return b"{" + b",".join(encode_json(name) + b":" + value for name, value in fields.items()) + b"}"
+
+
+ENCODERS = {
+    "json": encode_json,
+    "ndjson": encode_ndjson,
+    "msgpack": encode_msgpack,
+    "arrow": encode_arrow,
+}
+
+
+# Read the stored records of a device in the [start, end) window, calibrate, evaluate and
+# transform them with transform_frame(frame, *arguments) and encode the response: the
+# fields of head followed by mapped_data, downsampling and alerts. Run through
+# workers.run, so only the window goes into the process pool and only the encoded
+# response comes back.
+def render_device_data(head: dict, encoding: str, device_serial: str, window: tuple, arguments: tuple):
+    with metrics.stage("read"):
+        frame = read_frame(device_serial, *window)
+    device_data = transform_frame(frame, *arguments)
+    with metrics.stage("serialize"):
+        return ENCODERS[encoding]({**head, **device_data})
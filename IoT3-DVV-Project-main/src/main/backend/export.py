@@ -1,65 +1,215 @@
+from fastapi import HTTPException
 from fastapi.responses import StreamingResponse
-import pandas as pd
+import csv
 import io
 import json
-import datetime
-from calibration import scale_values
+import os
+import tempfile
+import textwrap
+import metrics
+import store
+import workers
+from calibration import CalibrationPlan, scale_frame
+from frames import RecordFrame, column_values, epoch_values, frame_from_records, frame_length, read_frame_page
+from timestamps import format_epochs
 
+# Export columns and the calibrated property each one is read from
+EXPORT_FIELDS = {
+    "V1": "V1_Voltage",
+    "V2": "V2_Voltage",
+    "V3": "V3_Voltage",
+    "I1": "I1_Current",
+    "I2": "I2_Current",
+    "I3": "I3_Current",
+    "KW_L1": "KW_L1",
+    "KW_L2": "KW_L2",
+    "KW_L3": "KW_L3",
+    "KVA_L1": "KVA_L1",
+    "KVA_L2": "KVA_L2",
+    "KVA_L3": "KVA_L3",
+    "PF_L1": "PF_L1",
+    "PF_L2": "PF_L2",
+    "PF_L3": "PF_L3",
+    "KWh_import": "KWh_import",
+    "KVAh_import": "KVAh_import",
+    "Frequency": "Frequency",
+}
 
-async def export_data(data_records, file_format: str, scaling_factors: dict, device_serial: str):
-    # Prepare export data
-    export_data = []
-    serial_number = device_serial
-    for record in data_records:
-        timestamp = record.get("created_at")
-        if timestamp:
-            dt = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-            date = dt.date().isoformat()  # YYYY-MM-DD format
-            time = dt.strftime("%H:%M:%S")  # HH:MM:SS format without milliseconds
+EXPORT_COLUMNS = ["date", "time"] + list(EXPORT_FIELDS)
+
+# Media types and supported compression codecs of the columnar formats
+COLUMNAR_MEDIA_TYPES = {
+    "parquet": "application/vnd.apache.parquet",
+    "arrow": "application/vnd.apache.arrow.file",
+}
+COLUMNAR_COMPRESSION = {
+    "parquet": ["none", "snappy", "gzip", "brotli", "lz4", "zstd"],
+    "arrow": ["none", "lz4", "zstd"],
+}
+
+# Bytes per chunk when streaming a written Parquet or Arrow file
+COLUMNAR_CHUNK_SIZE = 1 << 20
+
+
+# Calibrate one page of records into a frame
+def export_frame(page: list, plan: CalibrationPlan):
+    return scale_frame(plan, frame_from_records(page))
+
+
+# Build the export values of a calibrated frame, one list per column of EXPORT_COLUMNS
+def export_values(frame: RecordFrame):
+    # YYYY-MM-DD dates and HH:MM:SS times (without milliseconds)
+    dates, times = format_epochs(frame.epochs)
+    return [dates, times] + [column_values(frame, key) for key in EXPORT_FIELDS.values()]
+
+
+# Build the export rows of a calibrated frame
+def export_rows(frame: RecordFrame):
+    return [dict(zip(EXPORT_COLUMNS, row)) for row in zip(*export_values(frame))]
+
+
+# Read one page of the stored records of a device below end, calibrate it and format it
+# as CSV rows, JSON array items (without the separator before the first one) or NDJSON
+# lines. Returns the text, the number of records and the end of the page below (None
+# after the last page). Run through workers.run, so the records are read and decoded in
+# the process pool as well.
+def format_page(device_serial: str, start: int, end: int, file_format: str, plan: CalibrationPlan):
+    frame, next_end = read_frame_page(device_serial, start, end)
+    frame = scale_frame(plan, frame)
+    if file_format == "csv":
+        output = io.StringIO()
+        csv.writer(output, lineterminator="\n").writerows(zip(*export_values(frame)))
+        text = output.getvalue()
+    elif file_format == "json":
+        text = ",\n".join(textwrap.indent(json.dumps(row, indent=4), "    ") for row in export_rows(frame))
+    else:
+        text = "".join(json.dumps(row) + "\n" for row in export_rows(frame))
+    return text, frame_length(frame), next_end
+
+
+# Format the stored records of a device in the [start, end) window page by page
+async def format_pages(device_serial: str, window: tuple, file_format: str, plan: CalibrationPlan):
+    start, end = window
+    while end is not None:
+        text, records, end = await workers.run(format_page, device_serial, start, end, file_format, plan)
+        metrics.EXPORTED_RECORDS.inc(records, format=file_format)
+        if records:
+            yield text
+
+
+# Build the export columns for one page of records, with a real timestamp column of
+# epoch milliseconds
+def export_columns(page: list, plan: CalibrationPlan):
+    frame = export_frame(page, plan)
+    return {
+        "timestamp": epoch_values(frame),
+        **{column: column_values(frame, key) for column, key in EXPORT_FIELDS.items()},
+    }
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError:
+        raise HTTPException(status_code=501, detail="Parquet and Arrow exports need the 'pyarrow' package")
+    return pyarrow
+
+
+# Stream CSV text, one chunk per page of records
+async def stream_csv(device_serial: str, window: tuple, plan: CalibrationPlan):
+    output = io.StringIO()
+    csv.writer(output, lineterminator="\n").writerow(EXPORT_COLUMNS)
+    yield output.getvalue()
+    async for rows in format_pages(device_serial, window, "csv", plan):
+        yield rows
+
+
+# Stream a JSON array (formatted like json.dumps(rows, indent=4)), one chunk per page
+async def stream_json(device_serial: str, window: tuple, plan: CalibrationPlan):
+    separator = "[\n"
+    async for rows in format_pages(device_serial, window, "json", plan):
+        if rows:
+            yield separator + rows
+            separator = ",\n"
+    yield "[]" if separator == "[\n" else "\n]"
+
+
+# Stream newline-delimited JSON, one row per line
+async def stream_ndjson(device_serial: str, window: tuple, plan: CalibrationPlan):
+    async for rows in format_pages(device_serial, window, "ndjson", plan):
+        yield rows
+
+
+# Write the stored records of a device in the [start, end) window, calibrated, to a
+# Parquet file or an Arrow IPC file at path, one row group (or record batch) per
+# row_group_size rows. Returns the number of records written. Run through workers.run:
+# the writer keeps its state between row groups, so the whole file is written by one job.
+def write_columnar(
+        device_serial: str, window: tuple, path: str, file_format: str, compression, row_group_size: int,
+        plan: CalibrationPlan):
+    pa = import_pyarrow()
+    schema = pa.schema(
+        [("timestamp", pa.timestamp("ms", tz="UTC"))] + [(column, pa.float64()) for column in EXPORT_FIELDS]
+    )
+
+    if file_format == "parquet":
+        writer = pa.parquet.ParquetWriter(path, schema, compression=compression or "none")
+    else:
+        writer = pa.ipc.new_file(path, schema, options=pa.ipc.IpcWriteOptions(compression=compression))
+
+    def write(columns):
+        table = pa.table({name: pa.array(values, type=schema.field(name).type) for name, values in columns.items()})
+        if file_format == "parquet":
+            writer.write_table(table, row_group_size=row_group_size)
         else:
-            date = None
-            time = None
-
-        properties = record.get("property", {})
-        # Apply scaling to properties
-        scaled_properties = scale_values(device_serial, properties, scaling_factors)
-
-
-        row = {
-            "date": date,
-            "time": time,
-            "V1": scaled_properties.get("V1_Voltage"),
-            "V2": scaled_properties.get("V2_Voltage"),
-            "V3": scaled_properties.get("V3_Voltage"),
-            "I1": scaled_properties.get("I1_Current"),
-            "I2": scaled_properties.get("I2_Current"),
-            "I3": scaled_properties.get("I3_Current"),
-            "KW_L1": scaled_properties.get("KW_L1"),
-            "KW_L2": scaled_properties.get("KW_L2"),
-            "KW_L3": scaled_properties.get("KW_L3"),
-            "KVA_L1": scaled_properties.get("KVA_L1"),
-            "KVA_L2": scaled_properties.get("KVA_L2"),
-            "KVA_L3": scaled_properties.get("KVA_L3"),
-            "PF_L1": scaled_properties.get("PF_L1"),
-            "PF_L2": scaled_properties.get("PF_L2"),
-            "PF_L3": scaled_properties.get("PF_L3"),
-            "KWh_import": scaled_properties.get("KWh_import"),
-            "KVAh_import": scaled_properties.get("KVAh_import"),
-            "Frequency": scaled_properties.get("Frequency"),
-        }
-        export_data.append(row)
+            writer.write_table(table, max_chunksize=row_group_size)
+
+    records = 0
+    buffered = {name: [] for name in schema.names}
+    for page in store.iter_records(device_serial, *window):
+        records += len(page)
+        for name, values in export_columns(page, plan).items():
+            buffered[name].extend(values)
+
+        if len(buffered["timestamp"]) >= row_group_size:
+            write(buffered)
+            buffered = {name: [] for name in schema.names}
+
+    if buffered["timestamp"]:
+        write(buffered)
+    writer.close()
+    return records
 
+
+# Stream a Parquet file or an Arrow IPC file, written to a temporary file by
+# write_columnar in the process pool
+async def stream_columnar(
+        device_serial: str, window: tuple, file_format: str, compression, row_group_size: int,
+        plan: CalibrationPlan):
+    descriptor, path = tempfile.mkstemp(suffix=f".{file_format}")
+    os.close(descriptor)
+    try:
+        records = await workers.run(
+            write_columnar, device_serial, window, path, file_format, compression, row_group_size, plan)
+        metrics.EXPORTED_RECORDS.inc(records, format=file_format)
+        with open(path, "rb") as file:
+            while chunk := file.read(COLUMNAR_CHUNK_SIZE):
+                yield chunk
+    finally:
+        os.remove(path)
+
+
+# Stream the stored records of a device in the [start, end) window in file_format
+async def export_data(window: tuple, file_format: str, plan: CalibrationPlan, device_serial: str, compression: str = None, row_group_size: int = 100000):
     # Set default filename if serial_number is None
+    serial_number = device_serial
     filename = f"{serial_number or 'exported_data'}.{file_format}"
 
     if file_format == "csv":
-        # Convert to CSV
-        df = pd.DataFrame(export_data)
-        output = io.StringIO()
-        df.to_csv(output, index=False)
-        output.seek(0)
         return StreamingResponse(
-            io.BytesIO(output.getvalue().encode()),
+            metrics.timed_stream("export", stream_csv(device_serial, window, plan)),
             media_type="text/csv",
             headers={
                 "Content-Disposition": f"attachment; filename={filename}",
@@ -68,13 +218,37 @@ async def export_data(data_records, file_format: str, scaling_factors: dict, dev
         )
 
     elif file_format == "json":
-        # Convert to JSON
-        json_output = json.dumps(export_data, indent=4)
         return StreamingResponse(
-            io.BytesIO(json_output.encode()),
+            metrics.timed_stream("export", stream_json(device_serial, window, plan)),
             media_type="application/json",
             headers={
                 "Content-Disposition": f"attachment; filename={filename}",
                 "Content-Type": "application/json"
             }
         )
+
+    elif file_format == "ndjson":
+        return StreamingResponse(
+            metrics.timed_stream("export", stream_ndjson(device_serial, window, plan)),
+            media_type="application/x-ndjson",
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}",
+                "Content-Type": "application/x-ndjson"
+            }
+        )
+
+    elif file_format in COLUMNAR_MEDIA_TYPES:
+        import_pyarrow()
+        if compression and compression not in COLUMNAR_COMPRESSION[file_format]:
+            raise HTTPException(status_code=400, detail=f"Unsupported {file_format} compression: {compression}")
+        if compression is None and file_format == "parquet":
+            compression = "snappy"
+
+        return StreamingResponse(
+            metrics.timed_stream("export", stream_columnar(device_serial, window, file_format, None if compression == "none" else compression, row_group_size, plan)),
+            media_type=COLUMNAR_MEDIA_TYPES[file_format],
+            headers={
+                "Content-Disposition": f"attachment; filename={filename}",
+                "Content-Type": COLUMNAR_MEDIA_TYPES[file_format]
+            }
+        )
@@ -1,8 +1,21 @@
 from fastapi import HTTPException
 import httpx
-from datetime import datetime
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from datetime import datetime, timedelta, timezone
 from dotenv import load_dotenv
+import asyncio
+import importlib.util
+import json
+import logging
+import metrics
 import os
+import time
+import rollups
+import store
+import workers
+from coalesce import ResultCache
+from timestamps import parse_created_at, parse_timestamps
 
 # Load environment variables from .env file
 load_dotenv()
@@ -12,6 +25,170 @@ API_URL = os.getenv("API_URL")
 if not API_URL:
     raise Exception("API_URL is not set in the .env file")
 
+# Connection pool, timeout and retry settings for the upstream API
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20"))
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "10"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
+HTTP2 = os.getenv("HTTP2", "true").lower() == "true"
+
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+# At most UPSTREAM_CONCURRENCY upstream requests in flight across all devices, and one
+# store sync at a time per device
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "8"))
+upstream_semaphore = asyncio.Semaphore(UPSTREAM_CONCURRENCY)
+# Locks of the devices this process is syncing or waiting to sync, with the number of
+# tasks holding or awaiting each; a lock is dropped once no task needs it
+device_locks = {}
+
+# Several worker processes (uvicorn --workers) share the store: a device is then synced
+# by one process at a time, under a lease in the store, and sync results are shared
+# through the store for RESULT_CACHE_TTL seconds. Their store writes run in threads (see
+# store.run), since another process may hold the write lock.
+MULTI_WORKER = store.MULTI_WORKER
+# Seconds a device lease lasts unless renewed; it outlives a crashed worker by at most this
+DEVICE_LEASE_SECONDS = float(os.getenv("DEVICE_LEASE_SECONDS", "30"))
+# Seconds between checks while another worker holds the lease of a device
+DEVICE_LEASE_POLL = 0.05
+
+# Pages requested ahead of the page being parsed and stored while paging
+PREFETCH_PAGES = int(os.getenv("PREFETCH_PAGES", "2"))
+
+# Pages requested at most to find the first page of an old date range. Seeking sends
+# page tokens made up from the indexed ones, which relies on the undocumented token
+# format of the upstream API, so it is off (0) unless enabled.
+SEEK_MAX_PROBES = int(os.getenv("SEEK_MAX_PROBES", "0"))
+
+logger = logging.getLogger(__name__)
+
+# Results of fetch_data (device info and window, no records), shared by identical requests
+fetch_cache = ResultCache(shared="fetch_data" if MULTI_WORKER else None)
+
+# Shared client for every upstream request, opened and closed with the app lifespan
+client = None
+
+# Network totals of the request being served, see track_network()
+network_stats = ContextVar("network_stats", default=None)
+
+# Device lease held by the sync of the current task, see device_lock()
+sync_lease = ContextVar("sync_lease", default=None)
+
+
+# Renew a device lease until it is released. When another worker has taken it over,
+# the lease is marked as lost and no longer renewed.
+async def renew_lease(name: str, owner: str, lease: dict):
+    while True:
+        await asyncio.sleep(DEVICE_LEASE_SECONDS / 3)
+        expires = time.time() + DEVICE_LEASE_SECONDS
+        if not await store.run(store.acquire_lease, name, owner, expires):
+            print(f"Lost the lease {name}, stopping its sync")
+            lease["lost"] = True
+            return
+        lease["expires"] = expires
+
+
+# Stop the sync of the current task, before it stores anything more, once its device
+# lease was lost or has expired; another worker may be syncing the device by then
+def check_lease():
+    lease = sync_lease.get()
+    if lease is not None and (lease["lost"] or time.time() >= lease["expires"]):
+        raise HTTPException(status_code=503, detail="Device is being synced by another worker")
+
+
+# Hold the lock of a device in this process
+@asynccontextmanager
+async def local_device_lock(device_serial_number: str):
+    entry = device_locks.setdefault(device_serial_number, {"lock": asyncio.Lock(), "users": 0})
+    entry["users"] += 1
+    try:
+        async with entry["lock"]:
+            yield
+    finally:
+        entry["users"] -= 1
+        if not entry["users"]:
+            del device_locks[device_serial_number]
+
+
+# Hold the store sync of a device: the lock of this process and, with MULTI_WORKER, the
+# device's lease in the store, renewed while it is held
+@asynccontextmanager
+async def device_lock(device_serial_number: str):
+    async with local_device_lock(device_serial_number):
+        if not MULTI_WORKER:
+            yield
+            return
+
+        name, owner = f"sync:{device_serial_number}", str(os.getpid())
+        expires = time.time() + DEVICE_LEASE_SECONDS
+        while not await store.run(store.acquire_lease, name, owner, expires):
+            await asyncio.sleep(DEVICE_LEASE_POLL)
+            expires = time.time() + DEVICE_LEASE_SECONDS
+        lease = {"lost": False, "expires": expires}
+        renewal = asyncio.create_task(renew_lease(name, owner, lease))
+        token = sync_lease.set(lease)
+        try:
+            yield
+        finally:
+            sync_lease.reset(token)
+            renewal.cancel()
+            if not lease["lost"]:
+                await store.run(store.release_lease, name, owner)
+
+
+async def start_client():
+    global client
+    if client is None:
+        # HTTP/2 needs the optional 'h2' package (pip install httpx[http2])
+        http2 = HTTP2 and importlib.util.find_spec("h2") is not None
+        client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            timeout=httpx.Timeout(HTTP_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
+        )
+    return client
+
+
+async def close_client():
+    global client
+    if client is not None:
+        await client.aclose()
+        client = None
+
+
+# Start collecting upstream request count, time and bytes for the current request
+def track_network():
+    stats = {"requests": 0, "seconds": 0.0, "bytes_sent": 0, "bytes_received": 0}
+    network_stats.set(stats)
+    return stats
+
+
+def record_network(started: float, response: httpx.Response = None):
+    elapsed = time.perf_counter() - started
+    sent = len(response.request.content) if response is not None else 0
+    received = response.num_bytes_downloaded if response is not None else 0
+    logger.debug(f"Upstream request took {elapsed:.3f}s, sent {sent} bytes, received {received} bytes")
+
+    metrics.UPSTREAM_REQUESTS.inc(status=response.status_code if response is not None else "error")
+    metrics.UPSTREAM_BYTES_SENT.inc(sent)
+    metrics.UPSTREAM_BYTES_RECEIVED.inc(received)
+    metrics.record_stage("upstream", elapsed)
+
+    stats = network_stats.get()
+    if stats is not None:
+        stats["requests"] += 1
+        stats["seconds"] += elapsed
+        stats["bytes_sent"] += sent
+        stats["bytes_received"] += received
+
+
 # Make the API call to get both device info and paginated data
 async def make_api_request(device_serial_number: str, page_token: dict = None):
     body = {
@@ -24,10 +201,27 @@ async def make_api_request(device_serial_number: str, page_token: dict = None):
         body["page_token"] = page_token
 
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.post(API_URL, json=body)
-            response.raise_for_status()
-            return response.json()
+        http_client = client or await start_client()
+
+        # Retry transport errors and transient statuses with exponential backoff
+        for attempt in range(HTTP_RETRIES + 1):
+            try:
+                async with upstream_semaphore:
+                    started = time.perf_counter()
+                    response = await http_client.post(API_URL, json=body)
+            except httpx.TransportError as e:
+                record_network(started)
+                if attempt == HTTP_RETRIES:
+                    raise
+                print(f"Upstream request failed ({e!r}), retrying")
+            else:
+                record_network(started, response)
+                if response.status_code not in RETRY_STATUS_CODES or attempt == HTTP_RETRIES:
+                    response.raise_for_status()
+                    return response.json()
+                print(f"Upstream returned {response.status_code}, retrying")
+
+            await asyncio.sleep(HTTP_BACKOFF * 2 ** attempt)
     except httpx.HTTPStatusError as e:
         print(f"HTTP error occurred: {e.response.status_code} - {e.response.text}")
         raise HTTPException(status_code=e.response.status_code, detail=str(e))
@@ -35,136 +229,468 @@ async def make_api_request(device_serial_number: str, page_token: dict = None):
         print(f"Unexpected error in API request: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
-# Fetch device data with pagination, start and end dates
-async def fetch_data(device_serial_number: str, start_date: str, end_date: str, max_pages: int = 50, stable_count_threshold: int = 3):
-    page_token = None
-    all_data = []
-    date_found = False
-    stable_count = 0
-    last_record_count = 0
-    device_info = {}
 
+# Build the device info block from the most recent record of a device
+def build_device_info(first_record: dict):
+    created_at = first_record.get("created_at")
+    if created_at:
+        epoch = first_record.get("epoch") or parse_created_at(created_at)
+        formatted_created_at = datetime.fromtimestamp(epoch / 1000, timezone.utc).strftime("%Y/%m/%d %H:%M:%S")
+    else:
+        formatted_created_at = "N/A"
+
+    return {
+        "lastUpdate": formatted_created_at,
+        "DVer": "Version 1.0",
+        "PVer": "Version 1.0",
+        "deviceID": first_record.get("serialNumber"),
+        "deviceCategory": "Energy Meter",
+        "sourceSitename": "Energy Site",
+        "modelName": first_record.get("property", {}).get("modelname"),
+        "deviceName": first_record.get("property", {}).get("devicename"),
+        "version": first_record.get("property", {}).get("version"),
+        "macAddress": first_record.get("property", {}).get("mac address"),
+        "serialNumber": first_record.get("property", {}).get("serial number"),
+        "IPADD": first_record.get("property", {}).get("IPADD"),
+        "status": first_record.get("property", {}).get("status"),
+        "latestRecord" : {
+            "Date_Time" : formatted_created_at,
+            "created_at": first_record.get("created_at"),
+            "V1_Voltage": first_record.get("property", {}).get("V1_Voltage"),
+            "V2_Voltage": first_record.get("property", {}).get("V2_Voltage"),
+            "V3_Voltage": first_record.get("property", {}).get("V3_Voltage"),
+            "I1_Current": first_record.get("property", {}).get("I1_Current"),
+            "I2_Current": first_record.get("property", {}).get("I2_Current"),
+            "I3_Current": first_record.get("property", {}).get("I3_Current"),
+            "KW_L1": first_record.get("property", {}).get("KW_L1"),
+            "KW_L2": first_record.get("property", {}).get("KW_L2"),
+            "KW_L3": first_record.get("property", {}).get("KW_L3"),
+            "Kvar_L1": first_record.get("property", {}).get("Kvar_L1"),
+            "Kvar_L2": first_record.get("property", {}).get("Kvar_L2"),
+            "Kvar_L3": first_record.get("property", {}).get("Kvar_L3"),
+            "KVA_L1": first_record.get("property", {}).get("KVA_L1"),
+            "KVA_L2": first_record.get("property", {}).get("KVA_L2"),
+            "KVA_L3": first_record.get("property", {}).get("KVA_L3"),
+            "PF_L1": first_record.get("property", {}).get("PF_L1"),
+            "PF_L2": first_record.get("property", {}).get("PF_L2"),
+            "PF_L3": first_record.get("property", {}).get("PF_L3"),
+            "Frequency": first_record.get("property", {}).get("Frequency"),
+            "Total_Kvar": first_record.get("property", {}).get("Total_Kvar"),
+            "Total_KVA": first_record.get("property", {}).get("Total_KVA"),
+            "Total_PF": first_record.get("property", {}).get("Total_PF"),
+            "Total_KW": first_record.get("property", {}).get("Total_KW"),
+            "Kwh_Import": first_record.get("property", {}).get("Kwh_Import"),
+            "KVAh_import": first_record.get("property", {}).get("KVAh_import"),
+            "act": first_record.get("property", {}).get("act"),
+            "rssi": first_record.get("property", {}).get("rssi"),
+            "wwan_ip": first_record.get("property", {}).get("wwan_ip"),
+            "rsrp": first_record.get("property", {}).get("rsrp"),
+            "rsrq": first_record.get("property", {}).get("rsrq"),
+            "lte_rx": first_record.get("property", {}).get("lte_rx"),
+            "lte_tx": first_record.get("property", {}).get("lte_tx"),
+            "lte_bytes": first_record.get("property", {}).get("lte_bytes"),
+        }
+    }
+
+
+# Request the page at page_token and return its payload: the page's records followed
+# by an entry holding the token of the next page
+async def request_page(device_serial_number: str, page_token):
+    response_data = await make_api_request(device_serial_number, page_token)
+
+    if not response_data or "response" not in response_data:
+        print(f"Invalid response data: {response_data}")
+        raise HTTPException(status_code=500, detail="Invalid response from API")
+
+    return response_data.get("response", {}).get("Payload", [])
+
+
+# Parse the records of a page payload into (epoch, created_at, record JSON) rows for the
+# store, and aggregate them into the hourly rollups of the page. Runs in a worker thread,
+# so the event loop can send the next request meanwhile.
+@metrics.timed("parse")
+def parse_page(payload: list):
+    # Excluding the last element for pagination token
+    records = [record for record in payload[:-1] if record.get("created_at")]
     try:
-        # Parse the start and end dates
-        start_date_obj = datetime.fromisoformat(start_date).date()
-        end_date_obj = datetime.fromisoformat(end_date).date()
-
-        # Iterate over the pages
-        for _ in range(max_pages):
-            response_data = await make_api_request(device_serial_number, page_token)
-
-            if not response_data or "response" not in response_data:
-                print(f"Invalid response data: {response_data}")
-                raise HTTPException(status_code=500, detail="Invalid response from API")
-
-            payload = response_data.get("response", {}).get("Payload", [])
-
-            # Extract device info once, from the first page
-            if not device_info and payload:
-                first_record = payload[0]
-
-                created_at = first_record.get("created_at")
-                if created_at:
-                    formatted_created_at = datetime.fromisoformat(created_at).strftime("%Y/%m/%d %H:%M:%S")
-                else:
-                    formatted_created_at = "N/A"
-
-                device_info = {
-                    "lastUpdate": formatted_created_at,
-                    "DVer": "Version 1.0",
-                    "PVer": "Version 1.0",
-                    "deviceID": first_record.get("serialNumber"),
-                    "deviceCategory": "Energy Meter",
-                    "sourceSitename": "Energy Site",
-                    "modelName": first_record.get("property", {}).get("modelname"),
-                    "deviceName": first_record.get("property", {}).get("devicename"),
-                    "version": first_record.get("property", {}).get("version"),
-                    "macAddress": first_record.get("property", {}).get("mac address"),
-                    "serialNumber": first_record.get("property", {}).get("serial number"),
-                    "IPADD": first_record.get("property", {}).get("IPADD"),
-                    "status": first_record.get("property", {}).get("status"),
-                    "latestRecord" : {
-                        "Date_Time" : formatted_created_at,
-                        "created_at": first_record.get("created_at"),
-                        "V1_Voltage": first_record.get("property", {}).get("V1_Voltage"),
-                        "V2_Voltage": first_record.get("property", {}).get("V2_Voltage"),
-                        "V3_Voltage": first_record.get("property", {}).get("V3_Voltage"),
-                        "I1_Current": first_record.get("property", {}).get("I1_Current"),
-                        "I2_Current": first_record.get("property", {}).get("I2_Current"),
-                        "I3_Current": first_record.get("property", {}).get("I3_Current"),
-                        "KW_L1": first_record.get("property", {}).get("KW_L1"),
-                        "KW_L2": first_record.get("property", {}).get("KW_L2"),
-                        "KW_L3": first_record.get("property", {}).get("KW_L3"),
-                        "Kvar_L1": first_record.get("property", {}).get("Kvar_L1"),
-                        "Kvar_L2": first_record.get("property", {}).get("Kvar_L2"),
-                        "Kvar_L3": first_record.get("property", {}).get("Kvar_L3"),
-                        "KVA_L1": first_record.get("property", {}).get("KVA_L1"),
-                        "KVA_L2": first_record.get("property", {}).get("KVA_L2"),
-                        "KVA_L3": first_record.get("property", {}).get("KVA_L3"),
-                        "PF_L1": first_record.get("property", {}).get("PF_L1"),
-                        "PF_L2": first_record.get("property", {}).get("PF_L2"),
-                        "PF_L3": first_record.get("property", {}).get("PF_L3"),
-                        "Frequency": first_record.get("property", {}).get("Frequency"),
-                        "Total_Kvar": first_record.get("property", {}).get("Total_Kvar"),
-                        "Total_KVA": first_record.get("property", {}).get("Total_KVA"),
-                        "Total_PF": first_record.get("property", {}).get("Total_PF"),
-                        "Total_KW": first_record.get("property", {}).get("Total_KW"),
-                        "Kwh_Import": first_record.get("property", {}).get("Kwh_Import"),
-                        "KVAh_import": first_record.get("property", {}).get("KVAh_import"),
-                        "act": first_record.get("property", {}).get("act"),
-                        "rssi": first_record.get("property", {}).get("rssi"),
-                        "wwan_ip": first_record.get("property", {}).get("wwan_ip"),
-                        "rsrp": first_record.get("property", {}).get("rsrp"),
-                        "rsrq": first_record.get("property", {}).get("rsrq"),
-                        "lte_rx": first_record.get("property", {}).get("lte_rx"),
-                        "lte_tx": first_record.get("property", {}).get("lte_tx"),
-                        "lte_bytes": first_record.get("property", {}).get("lte_bytes"),
-                    }
-                }
-
-
-            if len(payload) == 0:
-                print("No data found in payload.")
-                break
+        epochs = parse_timestamps([record["created_at"] for record in records]).tolist()
+    except ValueError:
+        # Parse record by record to skip the records with a malformed timestamp
+        epochs, parsed = [], []
+        for record in records:
+            try:
+                epochs.append(parse_created_at(record["created_at"]))
+                parsed.append(record)
+            except ValueError as ve:
+                print(f"ValueError parsing date for record: {record}, error: {ve}")
+                continue
+        records = parsed
+
+    rows = [(epoch, record["created_at"], json.dumps(record)) for epoch, record in zip(epochs, records)]
+    hourly = rollups.aggregate_page(epochs, [record.get("property", {}) for record in records]) if rows else None
+    metrics.RECORDS.inc(len(rows), outcome="kept")
+    metrics.RECORDS.inc(len(payload) - 1 - len(rows), outcome="discarded")
+    return rows, hourly
+
+
+# Store the records of a page payload requested with page_token, together with the
+# position of the page and of the next one in the page index when seeking is enabled.
+# Returns the newest and oldest epoch of the page (None when it holds no records) and the
+# token of the next page.
+async def store_page(device_serial_number: str, page_token, payload: list):
+    if len(payload) == 0:
+        print("No data found in payload.")
+        return {"newest": None, "oldest": None, "page_token": None}
+
+    metrics.PAGES_FETCHED.inc()
+    rows, hourly = await asyncio.to_thread(parse_page, payload)
+
+    # Get the next page_token from the last record for pagination
+    next_token = payload[-1].get("page_token", None)
+
+    newest = max(row[0] for row in rows) if rows else None
+    oldest = min(row[0] for row in rows) if rows else None
+    positions = []
+    if rows and SEEK_MAX_PROBES > 0:
+        if page_token:
+            positions.append((page_token, newest, False))
+        if next_token:
+            # The next page starts just below this one
+            positions.append((next_token, oldest, True))
+
+    check_lease()
+    with metrics.stage("store"):
+        await store.run(store.add_records, device_serial_number, rows, positions)
+
+    if not rows:
+        return {"newest": None, "oldest": None, "page_token": next_token}
+
+    check_lease()
+    with metrics.stage("rollups"):
+        await rollups.update_rollups(device_serial_number, *hourly)
+
+    return {"newest": newest, "oldest": oldest, "page_token": next_token}
+
+
+async def fetch_page(device_serial_number: str, page_token):
+    payload = await request_page(device_serial_number, page_token)
+    return await store_page(device_serial_number, page_token, payload)
 
-            # Iterate through the payload, excluding the last element for pagination token
-            for record in payload[:-1]:
-                created_at = record.get("created_at")
-                if created_at:
-                    if created_at.endswith('+00:0'):
-                        created_at = created_at[:-1] + '00'
-                    try:
-                        record_date = datetime.fromisoformat(created_at).date()
-                        if start_date_obj <= record_date <= end_date_obj:
-                            all_data.append(record)
-                            date_found = True
-                        elif record_date < start_date_obj:
-                            stable_count = stable_count_threshold
-                            break
-                    except ValueError as ve:
-                        print(f"ValueError parsing date for record: {record}, error: {ve}")
-                        continue
-
-            # Check for stable record count to exit loop
-            if date_found:
-                current_record_count = len(all_data)
-                if current_record_count == last_record_count:
-                    stable_count += 1
-                else:
-                    stable_count = 0
-
-                if stable_count >= stable_count_threshold:
+
+# Whether the last (oldest) record of a page payload reaches stop_epoch, judged without
+# parsing the rest of the page
+def page_reaches(payload: list, stop_epoch: int):
+    for record in reversed(payload[:-1]):
+        created_at = record.get("created_at")
+        if created_at:
+            try:
+                return parse_created_at(created_at) <= stop_epoch
+            except ValueError:
+                continue
+    return False
+
+
+# Page the upstream API newest-first starting at page_token, storing every record seen,
+# until a page reaches stop_epoch or max_pages pages have been requested. Pages are
+# requested by a producer task as soon as the previous page's token is known, up to
+# PREFETCH_PAGES ahead, so a page is parsed and stored while the next one is in flight.
+async def walk_pages(device_serial_number: str, page_token, stop_epoch: int, max_pages: int):
+    newest = None
+    oldest = None
+    pages = 0
+    queue = asyncio.Queue(maxsize=max(PREFETCH_PAGES, 1))
+
+    async def produce(page_token):
+        request = None
+        try:
+            request = asyncio.create_task(request_page(device_serial_number, page_token))
+            for requested in range(1, max_pages + 1):
+                payload = await request
+                requested_token = page_token
+                page_token = payload[-1].get("page_token", None) if payload else None
+
+                # Send the next request before handing this page over for processing
+                request = None
+                if page_token and requested < max_pages and not page_reaches(payload, stop_epoch):
+                    request = asyncio.create_task(request_page(device_serial_number, page_token))
+                await queue.put((requested_token, payload))
+                if request is None:
                     break
+            await queue.put(None)
+        except Exception as e:
+            await queue.put(e)
+        finally:
+            if request is not None:
+                request.cancel()
+
+    producer = asyncio.create_task(produce(page_token))
+    try:
+        while True:
+            item = await queue.get()
+            if item is None:
+                break
+            if isinstance(item, Exception):
+                raise item
+
+            requested_token, payload = item
+            page = await store_page(device_serial_number, requested_token, payload)
+            pages += 1
+            page_token = page["page_token"]
 
-                last_record_count = current_record_count
+            if page["newest"] is not None:
+                newest = page["newest"] if newest is None else max(newest, page["newest"])
+                oldest = page["oldest"] if oldest is None else min(oldest, page["oldest"])
+                if page["oldest"] <= stop_epoch:
+                    break
 
-            # Get the next page_token from the last record for pagination
-            page_token = payload[-1].get("page_token", None) if payload else None
             if not page_token:
                 break
+    finally:
+        producer.cancel()
+
+    return {"newest": newest, "oldest": oldest, "page_token": page_token, "pages": pages}
+
+
+# Numeric value of a page token field: numbers as they are, timestamps as epoch
+# milliseconds, None for anything else
+def token_value(value):
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    if isinstance(value, str):
+        try:
+            return float(parse_created_at(value))
+        except ValueError:
+            return None
+    return None
+
+
+# Copy of the template token with its position field set to value, in the template's format
+def make_token(template: dict, key: str, value: float):
+    current = template[key]
+    if isinstance(current, str):
+        timespec = "milliseconds" if "." in current else "seconds"
+        value = datetime.fromtimestamp(value / 1000, timezone.utc).isoformat(timespec=timespec)
+        if current.endswith("Z"):
+            value = value.replace("+00:00", "Z")
+    elif isinstance(current, int):
+        value = int(round(value))
+    return {**template, key: value}
+
+
+# The token field that positions the upstream paging: the only numeric or timestamp
+# field whose value differs between the indexed tokens (or the only such field when a
+# single token is known). Returns (key, template token), or None when there is no
+# unambiguous position field.
+def position_field(positions: list):
+    tokens = [token for token, _ in positions if isinstance(token, dict)]
+    if not tokens:
+        return None
+
+    template = tokens[0]
+    tokens = [token for token in tokens if token.keys() == template.keys()]
+    keys = [key for key, value in template.items() if token_value(value) is not None]
+    if len(tokens) > 1:
+        keys = [key for key in keys if any(token[key] != template[key] for token in tokens)]
+
+    return (keys[0], template) if len(keys) == 1 else None
+
+
+# Estimate the position value at which paging starts at target_epoch, interpolating
+# between the nearest known positions on either side of it, or extrapolating from the
+# two nearest ones on one side
+def interpolate_position(samples: dict, target_epoch: int):
+    points = sorted(samples.items(), key=lambda item: item[1])
+    below = [point for point in points if point[1] < target_epoch]
+    above = [point for point in points if point[1] >= target_epoch]
+
+    if below and above:
+        (value_a, epoch_a), (value_b, epoch_b) = below[-1], above[0]
+    elif len(above) > 1:
+        (value_a, epoch_a), (value_b, epoch_b) = above[0], above[1]
+    elif len(below) > 1:
+        (value_a, epoch_a), (value_b, epoch_b) = below[-2], below[-1]
+    else:
+        return None
+
+    if epoch_a == epoch_b:
+        return None
+    return value_a + (target_epoch - epoch_a) * (value_b - value_a) / (epoch_b - epoch_a)
+
+
+# Jump to the page holding target_epoch instead of paging down to it: synthesize tokens
+# for the position field of the indexed page tokens and narrow in on the target by
+# interpolation search, requesting at most max_probes pages. Every page probed is stored
+# as a segment of its own. Returns the number of pages requested.
+#
+# When the upstream rejects a synthesized token (a 4xx response), seeking is turned off
+# for the device for good; on any other failure only this seek is given up. Either way
+# the caller pages down from the stored resume token instead.
+async def seek_page(device_serial_number: str, target_epoch: int, max_probes: int):
+    positions = store.get_page_positions(device_serial_number)
+    field = position_field(positions)
+    if field is None:
+        return 0
+
+    key, template = field
+    samples = {
+        token_value(token[key]): epoch
+        for token, epoch in positions
+        if isinstance(token, dict) and token.keys() == template.keys()
+    }
+
+    probes = 0
+    probed = set()
+    while probes < max_probes:
+        value = interpolate_position(samples, target_epoch)
+        if value is None:
+            break
 
-        return {"device_info": device_info, "data": all_data}
+        token = make_token(template, key, value)
+        value = token_value(token[key])
+        if value in probed:
+            break
+        probed.add(value)
 
+        probes += 1
+        try:
+            page = await fetch_page(device_serial_number, token)
+        except HTTPException as e:
+            print(f"Seeking failed for {device_serial_number} ({e.status_code}), paging instead")
+            if 400 <= e.status_code < 500:
+                await store.run(store.disable_seek, device_serial_number)
+            break
+        if page["newest"] is None:
+            # Past the end of the upstream history
+            break
+
+        check_lease()
+        await store.run(store.add_segment, device_serial_number, page["oldest"], page["newest"], page["page_token"])
+        samples[value] = page["newest"]
+        next_token = page["page_token"]
+        if isinstance(next_token, dict) and next_token.keys() == template.keys():
+            samples.setdefault(token_value(next_token[key]), page["oldest"])
+
+        if page["oldest"] <= target_epoch <= page["newest"]:
+            break
+
+    return probes
+
+
+# Bring the local store up to date for the [window_start, window_end) epoch window.
+# New records are paged from the head of the upstream history until the newest stored
+# record is reached, then gaps inside the window are filled by resuming from the page
+# token stored with the segment above each gap.
+async def sync_data(device_serial_number: str, window_start: int, window_end: int, max_pages: int):
+    budget = max_pages
+    segments = store.get_segments(device_serial_number)
+    head = segments[0] if segments else None
+    seek = SEEK_MAX_PROBES > 0 and not store.seek_disabled(device_serial_number)
+
+    if head is None or window_end > head["newest"]:
+        stop_epoch = head["newest"] if head else window_start
+        # Without stored history two head pages are enough to learn how the page tokens
+        # advance; the window is then reached through the page index below
+        head_pages = 2 if head is None and seek else budget
+        walk = await walk_pages(device_serial_number, None, stop_epoch, head_pages)
+        budget -= walk["pages"]
+        check_lease()
+        if walk["newest"] is not None:
+            await store.run(store.add_segment, device_serial_number, walk["oldest"], walk["newest"], walk["page_token"])
+
+    seeked = not seek
+    while budget > 0:
+        segments = store.get_segments(device_serial_number)
+        if not segments:
+            break
+
+        # Lowest segment reaching the top of the requested window, and the one below it
+        cursor = min(window_end - 1, segments[0]["newest"])
+        above = [segment for segment in segments if segment["newest"] >= cursor]
+        segment = above[-1]
+        below = segments[len(above)] if len(above) < len(segments) else None
+
+        if segment["oldest"] <= window_start or not segment["resume_token"]:
+            break
+
+        # Jump straight to the top of a window that lies below the segment, rather than
+        # paging through everything in between
+        if not seeked and segment["oldest"] > window_end:
+            seeked = True
+            probes = await seek_page(device_serial_number, window_end - 1, min(SEEK_MAX_PROBES, budget))
+            budget -= probes
+            if probes:
+                continue
+
+        stop_epoch = max(window_start, below["newest"]) if below else window_start
+        walk = await walk_pages(device_serial_number, segment["resume_token"], stop_epoch, budget)
+        budget -= walk["pages"]
+        check_lease()
+        if walk["newest"] is None:
+            await store.run(store.set_resume_token, segment, walk["page_token"])
+        else:
+            await store.run(
+                store.add_segment, device_serial_number, walk["oldest"], walk["newest"], walk["page_token"],
+                extends=segment)
+
+
+# Page the upstream head until the newest stored record (or after_epoch, for a device
+# without stored records) and return the stored records newer than after_epoch, newest first
+async def fetch_new_data(device_serial_number: str, after_epoch: int, max_pages: int = 50):
+    async with device_lock(device_serial_number):
+        segments = store.get_segments(device_serial_number)
+        stop_epoch = segments[0]["newest"] if segments else after_epoch
+        walk = await walk_pages(device_serial_number, None, stop_epoch, max_pages)
+        check_lease()
+        if walk["newest"] is not None:
+            await store.run(store.add_segment, device_serial_number, walk["oldest"], walk["newest"], walk["page_token"])
+
+    return [record for page in store.iter_records(device_serial_number, after_epoch + 1, 2 ** 62) for record in page]
+
+
+def get_newest_epoch(device_serial_number: str):
+    segments = store.get_segments(device_serial_number)
+    return segments[0]["newest"] if segments else None
+
+
+# Convert the requested dates into a [start, end) window of epoch milliseconds
+def date_window(start_date: str, end_date: str):
+    start_date_obj = datetime.fromisoformat(start_date).date()
+    end_date_obj = datetime.fromisoformat(end_date).date() + timedelta(days=1)
+    window_start = int(datetime.combine(start_date_obj, datetime.min.time(), timezone.utc).timestamp() * 1000)
+    window_end = int(datetime.combine(end_date_obj, datetime.min.time(), timezone.utc).timestamp() * 1000)
+    return window_start, window_end
+
+
+# Sync the store for the date range and return the device info together with the
+# [start, end) epoch window of the range
+async def sync_range(device_serial_number: str, start_date: str, end_date: str, max_pages: int = 50):
+    try:
+        window_start, window_end = date_window(start_date, end_date)
+
+        async with device_lock(device_serial_number):
+            await sync_data(device_serial_number, window_start, window_end, max_pages)
+
+        latest_record = store.get_latest_record(device_serial_number)
+        device_info = build_device_info(latest_record) if latest_record else {}
+
+        return {"device_info": device_info, "window": (window_start, window_end)}
+
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Internal Server Error: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+# Fetch device data with pagination, start and end dates into the store, and return the
+# device info and the window of the range (see sync_range). The records themselves are
+# read from the store by whoever processes them, in the process pool when there is one.
+# Identical concurrent requests share one fetch, and its result is reused for
+# RESULT_CACHE_TTL seconds.
+async def fetch_data(device_serial_number: str, start_date: str, end_date: str, max_pages: int = 50):
+    return await fetch_cache.get(
+        (device_serial_number, start_date, end_date, max_pages),
+        lambda: sync_range(device_serial_number, start_date, end_date, max_pages),
+    )
@@ -0,0 +1,195 @@
+import numpy as np
+import store
+from typing import NamedTuple
+from timestamps import NAT, record_epochs
+
+# Compact in-memory form of a range of records.
+#
+# Instead of one dict per record (with the device metadata repeated on each), a
+# RecordFrame holds an int64 epoch array, the created_at strings as one bytes array, a
+# float matrix with a column per numeric property in FRAME_CHANNELS (NaN where a value
+# is missing) and the text properties dictionary-encoded. Calibration, downsampling,
+# threshold evaluation, transformation and export all read the columns directly. The
+# device metadata is read once, from the latest record, by extract.build_device_info.
+
+# Numeric properties kept per record
+FRAME_CHANNELS = [
+    "V1_Voltage", "V2_Voltage", "V3_Voltage",
+    "I1_Current", "I2_Current", "I3_Current",
+    "KW_L1", "KW_L2", "KW_L3",
+    "Kvar_L1", "Kvar_L2", "Kvar_L3",
+    "KVA_L1", "KVA_L2", "KVA_L3",
+    "PF_L1", "PF_L2", "PF_L3",
+    "Total_Kvar", "Total_KVA", "Total_PF",
+    "Kwh_Import", "KVAh_import", "KWh_import", "Frequency",
+    "rssi", "rsrp", "rsrq",
+    "lte_rx", "lte_tx", "lte_bytes",
+]
+FRAME_COLUMNS = {key: column for column, key in enumerate(FRAME_CHANNELS)}
+
+# Text properties kept per record
+TEXT_CHANNELS = ["act", "wwan_ip"]
+
+
+# Records in a fixed order (newest first, as stored). `integers` marks the columns whose
+# values were all integers, so they are returned as ints again; `text` maps each text
+# property to its codes per record (-1 for missing) and the distinct values.
+class RecordFrame(NamedTuple):
+    epochs: np.ndarray
+    created_at: np.ndarray
+    values: np.ndarray
+    integers: np.ndarray
+    text: dict
+
+
+# Gather the given keys of a list of property dicts into a float matrix, with NaN where
+# a value is missing or not numeric
+def property_matrix(page_properties: list, channels: list):
+    matrix = np.full((len(page_properties), len(channels)), np.nan)
+    for column, key in enumerate(channels):
+        values = [properties.get(key) for properties in page_properties]
+        try:
+            matrix[:, column] = np.array(values, dtype=float)
+        except (TypeError, ValueError):
+            matrix[:, column] = [value if isinstance(value, (int, float)) else np.nan for value in values]
+    return matrix
+
+
+def to_list(values: np.ndarray):
+    return [None if value != value else value for value in values.tolist()]
+
+
+def text_column(values: list):
+    categories = {}
+    codes = np.array(
+        [-1 if value is None else categories.setdefault(value, len(categories)) for value in values], dtype=np.int32
+    )
+    return codes, list(categories)
+
+
+def frame_from_records(records: list):
+    page_properties = [record.get("property", {}) for record in records]
+    values = property_matrix(page_properties, FRAME_CHANNELS)
+
+    # A column keeps integer values if its first value is an int and all are whole numbers
+    first_values = [
+        next((properties[key] for properties in page_properties if properties.get(key) is not None), None)
+        for key in FRAME_CHANNELS
+    ]
+    with np.errstate(invalid="ignore"):
+        whole = np.all(np.isnan(values) | (values == np.trunc(values)), axis=0)
+    integers = whole & np.array([type(value) is int for value in first_values], dtype=bool)
+
+    return RecordFrame(
+        epochs=record_epochs(records),
+        created_at=np.array([(record.get("created_at") or "").encode() for record in records], dtype=bytes),
+        values=values,
+        integers=integers,
+        text={key: text_column([properties.get(key) for properties in page_properties]) for key in TEXT_CHANNELS},
+    )
+
+
+def empty_frame():
+    return frame_from_records([])
+
+
+def frame_length(frame: RecordFrame):
+    return len(frame.epochs)
+
+
+# Frame of the stored records of a device with start <= epoch < end, newest first, read
+# one page at a time
+def read_frame(device_serial: str, start: int, end: int):
+    return concat_frames([frame_from_records(page) for page in store.iter_records(device_serial, start, end)])
+
+
+# Frame of one page of stored records (see store.get_record_page) and the end of the
+# page below
+def read_frame_page(device_serial: str, start: int, end: int, page_size: int = 1000):
+    records, next_end = store.get_record_page(device_serial, start, end, page_size)
+    return frame_from_records(records), next_end
+
+
+# Concatenate frames in order into one frame
+def concat_frames(frames: list):
+    frames = [frame for frame in frames if frame_length(frame)]
+    if not frames:
+        return empty_frame()
+    if len(frames) == 1:
+        return frames[0]
+
+    text = {}
+    for key in TEXT_CHANNELS:
+        categories, codes = {}, []
+        for frame in frames:
+            frame_codes, frame_categories = frame.text[key]
+            mapping = np.array([categories.setdefault(value, len(categories)) for value in frame_categories] + [-1])
+            codes.append(mapping[frame_codes].astype(np.int32))
+        text[key] = (np.concatenate(codes), list(categories))
+
+    # Integer columns must be integer in every frame; a frame without values for a
+    # column does not decide
+    integers = np.all(
+        [frame.integers | np.isnan(frame.values).all(axis=0) for frame in frames], axis=0
+    ) & np.any([frame.integers for frame in frames], axis=0)
+
+    return RecordFrame(
+        epochs=np.concatenate([frame.epochs for frame in frames]),
+        created_at=np.concatenate([frame.created_at for frame in frames]),
+        values=np.concatenate([frame.values for frame in frames]),
+        integers=integers,
+        text=text,
+    )
+
+
+# The frame of the given rows (an index array or a slice)
+def take_rows(frame: RecordFrame, rows):
+    return frame._replace(
+        epochs=frame.epochs[rows],
+        created_at=frame.created_at[rows],
+        values=frame.values[rows],
+        text={key: (codes[rows], categories) for key, (codes, categories) in frame.text.items()},
+    )
+
+
+def reverse_frame(frame: RecordFrame):
+    return take_rows(frame, slice(None, None, -1))
+
+
+# Matrix of the given numeric properties
+def frame_matrix(frame: RecordFrame, keys: list):
+    return frame.values[:, [FRAME_COLUMNS[key] for key in keys]]
+
+
+# A frame with the given numeric properties replaced by float values
+def with_values(frame: RecordFrame, keys: list, values: np.ndarray):
+    columns = [FRAME_COLUMNS[key] for key in keys]
+    frame_values = frame.values.copy()
+    frame_values[:, columns] = values
+    integers = frame.integers.copy()
+    integers[columns] = False
+    return frame._replace(values=frame_values, integers=integers)
+
+
+# Values of one property as a list of Python values, None where missing
+def column_values(frame: RecordFrame, key: str):
+    if key in frame.text:
+        codes, categories = frame.text[key]
+        lookup = categories + [None]
+        return [lookup[code] for code in codes.tolist()]
+
+    column = FRAME_COLUMNS[key]
+    values = frame.values[:, column]
+    if frame.integers[column]:
+        return [None if value != value else int(value) for value in values.tolist()]
+    return to_list(values)
+
+
+# created_at of every record, None where missing
+def created_at_values(frame: RecordFrame):
+    return [value.decode() or None for value in frame.created_at.tolist()]
+
+
+# Epoch milliseconds of every record, None where missing
+def epoch_values(frame: RecordFrame):
+    return [None if epoch == NAT else epoch for epoch in frame.epochs.tolist()]
@@ -0,0 +1,142 @@
+import asyncio
+import json
+import logging
+import os
+import store
+import time
+from extract import fetch_new_data, get_newest_epoch
+
+# Seconds between upstream polls of a device with live subscribers, by default and at least
+LIVE_POLL_INTERVAL = float(os.getenv("LIVE_POLL_INTERVAL", "10"))
+# Deltas buffered per subscriber before it is asked to resync
+SUBSCRIBER_QUEUE_SIZE = int(os.getenv("SUBSCRIBER_QUEUE_SIZE", "100"))
+
+logger = logging.getLogger(__name__)
+
+
+# Server-Sent Events message
+def sse_message(event: str, data: dict):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+# Stored records of a device with after < epoch <= until, newest first
+def read_records(device_serial_number: str, after: int, until: int):
+    return [record for page in store.iter_records(device_serial_number, after + 1, until + 1) for record in page]
+
+
+# One background poller per device and polling interval. Every `interval` seconds it
+# pages only the records that are new since its last poll, turns them into a delta with
+# build_delta(device_serial_number, records) and encodes it once, then hands the same
+# message to every subscriber queue. Pollers of the same device at other intervals read
+# the records another one already stored from the store.
+#
+# Every subscriber has a cursor: the newest epoch it has, as given by the client when it
+# subscribed, then the newest one sent to it. A subscriber whose cursor is not where the
+# poll started (it joined with data older or newer than the poller's) gets a delta of its
+# own, read from the store, holding exactly the records after its cursor.
+class DevicePoller:
+    def __init__(self, device_serial_number: str, interval: float, build_delta):
+        self.device_serial_number = device_serial_number
+        self.interval = interval
+        self.build_delta = build_delta
+        self.subscribers = {}
+        self.task = None
+        self.last_epoch = None
+
+    def subscribe(self, since: int = None):
+        queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.subscribers[queue] = since
+        if since is not None and self.last_epoch is not None and since < self.last_epoch:
+            # Catch up on the records the poller already published before this subscriber joined
+            self.send_records(queue, since, self.last_epoch)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        return queue
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        self.subscribers.pop(queue, None)
+        if not self.subscribers and self.task:
+            self.task.cancel()
+            self.task = None
+
+    def send(self, queue: asyncio.Queue, message: str):
+        try:
+            queue.put_nowait(message)
+        except asyncio.QueueFull:
+            # A subscriber that cannot keep up drops its backlog and refetches
+            while not queue.empty():
+                queue.get_nowait()
+            queue.put_nowait(sse_message("resync", {}))
+
+    # Send a subscriber a delta of its own with the stored records after < epoch <= until
+    def send_records(self, queue: asyncio.Queue, after: int, until: int):
+        records = read_records(self.device_serial_number, after, until)
+        if records:
+            self.send(queue, sse_message("delta", self.build_delta(self.device_serial_number, records)))
+        self.subscribers[queue] = until
+
+    # Hand the records of a poll that started at `previous` to every subscriber
+    def publish(self, previous: int, records: list):
+        newest = records[0]["epoch"]
+        message = None
+        for queue, cursor in list(self.subscribers.items()):
+            if cursor is None or cursor == previous:
+                if message is None:
+                    message = sse_message("delta", self.build_delta(self.device_serial_number, records))
+                self.send(queue, message)
+                self.subscribers[queue] = newest
+            elif cursor < newest:
+                self.send_records(queue, cursor, newest)
+
+    async def poll(self):
+        if self.last_epoch is None:
+            self.last_epoch = get_newest_epoch(self.device_serial_number) or int(time.time() * 1000)
+            for queue, cursor in list(self.subscribers.items()):
+                if cursor is not None and cursor < self.last_epoch:
+                    self.send_records(queue, cursor, self.last_epoch)
+
+        previous = self.last_epoch
+        records = await fetch_new_data(self.device_serial_number, previous)
+        if records:
+            self.last_epoch = records[0]["epoch"]
+            self.publish(previous, records)
+
+    async def run(self):
+        while self.subscribers:
+            try:
+                await self.poll()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Live poll of {self.device_serial_number} failed: {str(e)}")
+            await asyncio.sleep(self.interval)
+
+
+pollers = {}
+
+
+# Subscribe to the deltas of a device, polled every `interval` seconds (LIVE_POLL_INTERVAL
+# when not given, and never more often), starting after the epoch `since` (the newest
+# record the client has) or, without it, at the next poll. Returns the subscriber queue
+# and the poller key to unsubscribe with.
+def subscribe(device_serial_number: str, build_delta, interval: float = None, since: int = None):
+    key = (device_serial_number, max(interval or LIVE_POLL_INTERVAL, LIVE_POLL_INTERVAL))
+    poller = pollers.get(key)
+    if poller is None:
+        poller = pollers[key] = DevicePoller(*key, build_delta)
+    return poller.subscribe(since), key
+
+
+def unsubscribe(key: tuple, queue: asyncio.Queue):
+    poller = pollers.get(key)
+    if poller is not None:
+        poller.unsubscribe(queue)
+        if not poller.subscribers:
+            del pollers[key]
+
+
+def stop_all():
+    for poller in pollers.values():
+        if poller.task:
+            poller.task.cancel()
+    pollers.clear()
@@ -1,15 +1,45 @@
-from fastapi import FastAPI, HTTPException, Query
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from extract import fetch_data
+from fastapi.responses import PlainTextResponse, Response, StreamingResponse
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional, Union
+from contextlib import asynccontextmanager
+from extract import fetch_data, sync_range, date_window, build_device_info, device_lock, start_client, close_client, track_network
 from export import export_data
-from transform import transform_data
-from calibration import load_scaling_factors, scale_values
+from transform import transform_columnar
+from thresholds import evaluate_range
+from rollups import ensure_rollups, read_rollups
+from downsample import CHANNELS
+from encoding import ENCODERS, MEDIA_TYPES, encode_json, join_json, render_device_data, require_encoding
+import live
+import metrics
+import workers
+from coalesce import ResultCache
+from calibration import scale_values, get_plan, scale_frame
+from frames import frame_from_records
+import config
+import asyncio
 import logging
 import json
+import os
+import time
+
+
+# Open the shared upstream HTTP client on startup and close it on shutdown
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await start_client()
+    config.start_watcher()
+    workers.start_pool()
+    yield
+    config.stop_watcher()
+    live.stop_all()
+    workers.stop_pool()
+    await close_client()
+
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # CORS configuration
 app.add_middleware(
@@ -20,6 +50,9 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request counts, durations and response sizes, and the optional Server-Timing header
+app.add_middleware(metrics.MetricsMiddleware)
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -28,18 +61,17 @@ logger = logging.getLogger(__name__)
 httpx_logger = logging.getLogger("httpx")
 httpx_logger.setLevel(logging.WARNING)
 
-# Load scaling factors from calibration JSON
-scaling_factors = load_scaling_factors('calibration.json')
-
+# Load calibration, thresholds and units; they are reloaded when the files change
+config.current()
 
-# Load threshold values from thresholds.json
-def load_threshold_values(filename: str):
-    """Load threshold values from a JSON file."""
-    with open(filename, 'r') as file:
-        return json.load(file)
+# Channels whose per-bucket min/max may be requested with minmax_channels
+MinmaxChannel = Literal[tuple(CHANNELS)]
 
+# Devices fetched concurrently by one batch request
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
 
-THRESHOLD_VALUES = load_threshold_values('thresholds.json')
+# Responses of build_device_data, shared by identical requests
+device_data_cache = ResultCache(size=len)
 
 
 # Response model for fetch-and-transform endpoint
@@ -47,70 +79,360 @@ class ResponseModel(BaseModel):
     status: str
     device_info: dict
     threshold_values: dict
-    mapped_data: list
+    mapped_data: Union[list, dict]
+    downsampling: Optional[dict] = None
+    alerts: Optional[dict] = None
+
+
+# Request body for the batch endpoint
+class BatchRequest(BaseModel):
+    device_serial_numbers: List[str]
+    start_date: str
+    end_date: str
+    max_pages: int = 50
+    max_points: Optional[int] = Field(None, ge=3)
+    resolution: Optional[int] = Field(None, ge=1)
+    downsample: Literal["minmax", "lttb"] = "minmax"
+    minmax_channels: List[MinmaxChannel] = []
+    format: Literal["records", "columnar"] = "records"
+    epoch_timestamps: bool = False
+    alerts: bool = True
+    stream: bool = False
+
+
+# Fetch, calibrate, downsample and transform one device's data for the date range, and
+# encode it as a response (see encoding.render_device_data) made of the head_fields
+# followed by mapped_data, downsampling and alerts. Identical concurrent requests share
+# one computation, whose result is reused for RESULT_CACHE_TTL seconds or until the
+# configuration is reloaded.
+async def build_device_data(
+        device_serial_number: str,
+        start_date: str,
+        end_date: str,
+        max_pages: int,
+        max_points: int = None,
+        resolution: int = None,
+        downsample: str = "minmax",
+        minmax_channels: list = (),
+        columnar: bool = False,
+        epoch_timestamps: bool = False,
+        alerts: bool = True,
+        encoding: str = "json",
+        head_fields: tuple = ("status", "device_info", "threshold_values")
+):
+    arguments = (
+        device_serial_number, start_date, end_date, max_pages, max_points, resolution, downsample,
+        tuple(dict.fromkeys(minmax_channels)), columnar, epoch_timestamps, alerts, encoding, head_fields)
+    return await device_data_cache.get(
+        (config.current().mtimes,) + arguments, lambda: compute_device_data(*arguments))
+
+
+async def compute_device_data(
+        device_serial_number: str,
+        start_date: str,
+        end_date: str,
+        max_pages: int,
+        max_points: int,
+        resolution: int,
+        downsample: str,
+        minmax_channels: tuple,
+        columnar: bool,
+        epoch_timestamps: bool,
+        alerts: bool,
+        encoding: str,
+        head_fields: tuple
+):
+    started = time.perf_counter()
+    network = track_network()
+
+    # Sync the range into the store, which returns device_info and the window to read
+    with metrics.stage("fetch"):
+        synced = await fetch_data(device_serial_number, start_date, end_date, max_pages)
+    # The synced data is shared with identical requests; update a copy
+    device_info = dict(synced.get('device_info'))
+
+    settings = config.current()
+    scaled_latest_record = scale_values(device_serial_number, device_info["latestRecord"], settings.scaling_factors)
+    device_info["latestRecord"] = scaled_latest_record
+
+    fields = {
+        "device_serial_number": device_serial_number,
+        "status": "success",
+        "device_info": device_info,
+        "threshold_values": settings.thresholds,
+    }
+    head = {name: fields[name] for name in head_fields}
+
+    # Read, calibrate, evaluate, transform and encode in the process pool, when there is one
+    content = await workers.run(render_device_data, head, encoding, device_serial_number, synced["window"], (
+        get_plan(device_serial_number, settings.calibration_plans), settings.threshold_plan, settings.units,
+        max_points, resolution, downsample, minmax_channels, columnar, epoch_timestamps, alerts))
+
+    logger.info(
+        f"Served {device_serial_number} in {time.perf_counter() - started:.3f}s, of which "
+        f"{network['seconds']:.3f}s upstream over {network['requests']} requests "
+        f"({network['bytes_received']} bytes received)")
+
+    return content
 
 
 @app.get("/fetch-and-transform", response_model=ResponseModel)
-async def fetch_and_transform(device_serial_number: str, start_date: str, end_date: str, max_pages: int = 50):
+async def fetch_and_transform(
+        device_serial_number: str,
+        start_date: str,
+        end_date: str,
+        max_pages: int = 50,
+        max_points: Optional[int] = Query(None, ge=3),
+        resolution: Optional[int] = Query(None, ge=1),
+        downsample: str = Query("minmax", enum=["minmax", "lttb"]),
+        minmax_channels: List[MinmaxChannel] = Query([]),
+        format: str = Query("records", enum=["records", "columnar", "msgpack", "arrow"]),
+        epoch_timestamps: bool = False,
+        alerts: bool = True
+):
     """
     Fetches and transforms device data within the specified date range.
+    With max_points (a point budget) or resolution (bucket width in seconds) the series
+    are downsampled server-side; see downsample.downsample_frame. The per-bucket min/max
+    of the minmax mode is only returned for the channels given in minmax_channels (repeat it).
+    format=columnar returns mapped_data as one array per series (see transform.transform_columnar),
+    and msgpack / arrow return the columnar response in a binary encoding.
+    alerts=false skips the threshold evaluation; alerts is then null.
     """
     try:
         logger.info(f"Fetching data from the backend for the dates {start_date} to {end_date}")
 
-        # Fetch data, which includes device_info and data records
-        extracted_data = await fetch_data(device_serial_number, start_date, end_date, max_pages)
-        device_info = extracted_data.get('device_info')
+        encoding = format if format in ("msgpack", "arrow") else "json"
+        require_encoding(encoding)
 
-        scaled_latest_record = scale_values(device_serial_number, device_info["latestRecord"], scaling_factors)
-        device_info["latestRecord"] = scaled_latest_record
+        # The response with device_info, threshold values, and mapped data, already encoded
+        content = await build_device_data(
+            device_serial_number, start_date, end_date, max_pages, max_points, resolution, downsample,
+            minmax_channels, format != "records", epoch_timestamps, alerts, encoding)
+        return Response(content, media_type=MEDIA_TYPES[encoding])
 
-        data_records = extracted_data.get('data', [])
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Internal Server Error: {str(e)}")
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+@app.post("/fetch-and-transform/batch")
+async def fetch_and_transform_batch(request: BatchRequest):
+    """
+    Fetches and transforms several devices concurrently, at most BATCH_CONCURRENCY at a time.
+    Returns the results keyed by device serial number, or with stream=true streams one
+    NDJSON line per device as soon as it is ready (after a first line with the threshold values).
+    A failing device is reported with status "error" without failing the others.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    # Every device result is encoded on its own: as a line of its own when streamed,
+    # or as a value of the results object
+    encoding = "ndjson" if request.stream else "json"
+    head_fields = ("device_serial_number", "status", "device_info") if request.stream else ("status", "device_info")
 
-        # Scale the values for each record
-        for record in data_records:
-            properties = record.get("property", {})
-            scaled_properties = scale_values(device_serial_number, properties, scaling_factors)
-            record['property'] = scaled_properties
+    async def run(device_serial_number: str):
+        async with semaphore:
+            try:
+                return device_serial_number, await build_device_data(
+                    device_serial_number, request.start_date, request.end_date, request.max_pages,
+                    request.max_points, request.resolution, request.downsample, request.minmax_channels,
+                    request.format == "columnar", request.epoch_timestamps, request.alerts, encoding, head_fields)
+            except Exception as e:
+                logger.error(f"Error fetching {device_serial_number} in batch: {str(e)}")
+                error = {"status": "error", "detail": getattr(e, "detail", "Internal Server Error")}
+                if request.stream:
+                    error = {"device_serial_number": device_serial_number, **error}
+                return device_serial_number, ENCODERS[encoding](error)
 
-        # Transform the scaled data
-        transformed_data = transform_data(data_records)
+    device_serial_numbers = list(dict.fromkeys(request.device_serial_numbers))
+    logger.info(f"Fetching {len(device_serial_numbers)} devices for the dates {request.start_date} to {request.end_date}")
+
+    if request.stream:
+        async def stream_results():
+            tasks = [asyncio.create_task(run(device_serial_number)) for device_serial_number in device_serial_numbers]
+            try:
+                yield json.dumps({"status": "success", "threshold_values": config.current().thresholds}) + "\n"
+                for completed in asyncio.as_completed(tasks):
+                    _, line = await completed
+                    yield line + b"\n"
+            finally:
+                for task in tasks:
+                    task.cancel()
+
+        return StreamingResponse(stream_results(), media_type="application/x-ndjson")
+
+    results = await asyncio.gather(*[run(device_serial_number) for device_serial_number in device_serial_numbers])
+    return Response(join_json({
+        "status": encode_json("success"),
+        "threshold_values": encode_json(config.current().thresholds),
+        "results": join_json(dict(results)),
+    }), media_type="application/json")
+
+
+@app.get("/alerts")
+async def alerts(
+    start_date: str,
+    end_date: str,
+    device_serial_number: List[str] = Query(...),
+    max_pages: int = 50,
+    max_intervals: int = Query(100, ge=0)
+):
+    """
+    Threshold violations of one or more devices (repeat device_serial_number) for the date
+    range, without the data series: per device the number of samples and violations, and
+    per channel its violation count and most recent violation intervals.
+    """
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+
+    async def run(device_serial_number: str):
+        async with semaphore:
+            try:
+                synced = await sync_range(device_serial_number, start_date, end_date, max_pages)
+                settings = config.current()
+                device_alerts = await workers.run(
+                    evaluate_range, settings.threshold_plan, get_plan(device_serial_number, settings.calibration_plans),
+                    device_serial_number, synced["window"], max_intervals)
+                return device_serial_number, {"status": "success", **device_alerts}
+            except Exception as e:
+                logger.error(f"Error evaluating alerts of {device_serial_number}: {str(e)}")
+                return device_serial_number, {"status": "error", "detail": getattr(e, "detail", "Internal Server Error")}
+
+    device_serial_numbers = list(dict.fromkeys(device_serial_number))
+    results = await asyncio.gather(*[run(device_serial_number) for device_serial_number in device_serial_numbers])
+    return {"status": "success", "results": dict(results)}
+
+
+@app.get("/rollups")
+async def get_rollups(
+    device_serial_number: str,
+    start_date: str,
+    end_date: str,
+    resolution: str = Query("day", enum=["hour", "day"]),
+    sync: bool = False,
+    max_pages: int = 50,
+    epoch_timestamps: bool = False
+):
+    """
+    Hourly or daily summary of a device for the date range, read from the rollups kept
+    in the store: per bucket the number of samples, the energy used (Kwh_Import and
+    KVAh_import deltas) and the min, max and mean of the other channels, calibrated.
+    Only stored records are summarized; sync=true first fetches the range like /export.
+    """
+    try:
+        if sync:
+            await sync_range(device_serial_number, start_date, end_date, max_pages)
+        # Not while the device is being synced, which updates the rollups as well
+        async with device_lock(device_serial_number):
+            await ensure_rollups(device_serial_number)
+
+        window_start, window_end = date_window(start_date, end_date)
+        settings = config.current()
+        summary = read_rollups(
+            device_serial_number, resolution, window_start, window_end,
+            get_plan(device_serial_number, settings.calibration_plans), epoch_timestamps)
 
-        # Return the response with device_info, threshold values, and mapped data
         return {
             "status": "success",
-            "device_info": device_info,
-            "threshold_values": THRESHOLD_VALUES,
-            "mapped_data": transformed_data
+            "device_serial_number": device_serial_number,
+            "resolution": resolution,
+            "units": settings.units,
+            **summary
         }
 
+    except HTTPException:
+        raise
     except Exception as e:
-        logger.error(f"Internal Server Error: {str(e)}")
+        logger.error(f"Error reading rollups: {str(e)}")
         raise HTTPException(status_code=500, detail="Internal Server Error")
 
 
+# Calibrate and transform newly fetched records into a live delta
+def build_live_delta(device_serial_number: str, data_records: list):
+    settings = config.current()
+    device_info = build_device_info(data_records[0])
+    device_info["latestRecord"] = scale_values(device_serial_number, device_info["latestRecord"], settings.scaling_factors)
+
+    frame = scale_frame(get_plan(device_serial_number, settings.calibration_plans), frame_from_records(data_records))
+
+    return {"device_info": device_info, "mapped_data": transform_columnar(frame, units=settings.units)}
+
+
+@app.get("/subscribe")
+async def subscribe(
+        device_serial_number: str,
+        request: Request,
+        interval: Optional[int] = Query(None, ge=1),
+        since: Optional[int] = Query(None, ge=0)
+):
+    """
+    Server-Sent Events stream of new data for a device. One background poller per device
+    and interval fetches only the new records every `interval` seconds (by default, and
+    at least, LIVE_POLL_INTERVAL), and all of its subscribers receive the same "delta"
+    events, holding device_info and the new records in the columnar format. With `since`
+    (epoch milliseconds of the newest record the client has), the deltas hold exactly the
+    records after it, starting with any the poller already published. A "resync" event
+    asks a subscriber that fell behind to refetch.
+    """
+    queue, key = live.subscribe(device_serial_number, build_live_delta, interval, since)
+
+    async def events():
+        try:
+            while not await request.is_disconnected():
+                try:
+                    yield await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    # Comment line to keep the connection open
+                    yield ": keep-alive\n\n"
+        finally:
+            live.unsubscribe(key, queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+
 @app.get("/export")
 async def export(
         device_serial_number: str,
         start_date: str,
         end_date: str,
         max_pages: int = 50,
-        file_format: str = Query("csv", enum=["csv", "json"])
+        file_format: str = Query("csv", enum=["csv", "json", "ndjson", "parquet", "arrow"]),
+        compression: str = Query(None, enum=["none", "snappy", "gzip", "brotli", "lz4", "zstd"]),
+        row_group_size: int = Query(100000, ge=1)
 ):
     """
-    Exports calibrated device data in CSV or JSON format within the specified date range.
+    Streams calibrated device data as CSV, JSON, NDJSON, Parquet or Arrow IPC within the specified date range.
+    The compression and row_group_size options apply to the Parquet and Arrow formats.
     """
     try:
         logger.info(
             f"Starting export for device {device_serial_number} from {start_date} to {end_date} as {file_format}")
 
-        # Fetch the data
-        extracted_data = await fetch_data(device_serial_number, start_date, end_date, max_pages)
-        data_records = extracted_data.get('data', [])
+        # Sync the data; the records are then streamed page by page from the store
+        network = track_network()
+        synced = await sync_range(device_serial_number, start_date, end_date, max_pages)
+        logger.info(
+            f"Synced {device_serial_number} for export, {network['seconds']:.3f}s upstream over "
+            f"{network['requests']} requests ({network['bytes_received']} bytes received)")
 
         # Calibrate and export data
-        return await export_data(data_records, file_format, scaling_factors, device_serial_number)
+        return await export_data(
+            synced["window"], file_format, get_plan(device_serial_number, config.current().calibration_plans), device_serial_number,
+            compression, row_group_size)
 
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error during export: {str(e)}")
-        raise HTTPException(status_code=500, detail="Internal Server Error")
\ No newline at end of file
+        raise HTTPException(status_code=500, detail="Internal Server Error")
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Counters and histograms in the Prometheus text format: requests, response bytes and
+    durations per route, upstream requests, bytes, pages and records, exported records,
+    and the duration of every pipeline stage (dvv_stage_seconds).
+    """
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
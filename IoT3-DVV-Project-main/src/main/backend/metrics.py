@@ -0,0 +1,210 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import os
+import threading
+import time
+
+# Counters and histograms of the request pipeline, exposed in the Prometheus text format
+# on /metrics.
+#
+# Code wraps each pipeline stage in `with stage("name")` (or decorates it with
+# @timed("name")). Its duration is observed in the dvv_stage_seconds histogram and, for
+# the request being served, summed per stage so MetricsMiddleware can report it in a
+# Server-Timing header when SERVER_TIMING is enabled.
+
+# Add a Server-Timing header with the per-stage durations to every response
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+# Origin allowed to read the Server-Timing header (the dashboard)
+TIMING_ALLOW_ORIGIN = os.getenv("TIMING_ALLOW_ORIGIN", "http://localhost:3000")
+
+DURATION_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Stage durations of the request being served, see track_request()
+request_timings = ContextVar("request_timings", default=None)
+
+_lock = threading.Lock()
+_metrics = []
+
+
+def quote(value):
+    return '"' + str(value).replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def format_labels(labelnames: tuple, labels: tuple, extra: str = ""):
+    pairs = [f"{name}={quote(value)}" for name, value in zip(labelnames, labels)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float):
+    return str(int(value)) if value == int(value) else repr(value)
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+        _metrics.append(self)
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for key, value in sorted(self.values.items()):
+            lines.append(f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DURATION_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        # Per label set: the count of each bucket (not cumulative), the sum and the count
+        self.values = {}
+        _metrics.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with _lock:
+            counts, total, count = self.values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self.values[key] = (counts, total + value, count + 1)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for key, (counts, total, count) in sorted(self.values.items()):
+            labels = format_labels(self.labelnames, key)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, 'le=%s' % quote(bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{format_labels(self.labelnames, key, 'le=%s' % quote('+Inf'))} {count}")
+            lines.append(f"{self.name}_sum{labels} {repr(total)}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+
+STAGE_SECONDS = Histogram("dvv_stage_seconds", "Duration of pipeline stages", ("stage",))
+HTTP_REQUESTS = Counter("dvv_http_requests_total", "Requests served", ("path", "status"))
+HTTP_SECONDS = Histogram("dvv_http_request_seconds", "Time until the response was complete", ("path",))
+HTTP_BYTES_SENT = Counter("dvv_http_response_bytes_total", "Response body bytes sent", ("path",))
+UPSTREAM_REQUESTS = Counter("dvv_upstream_requests_total", "Upstream API requests", ("status",))
+UPSTREAM_BYTES_SENT = Counter("dvv_upstream_bytes_sent_total", "Request body bytes sent upstream")
+UPSTREAM_BYTES_RECEIVED = Counter("dvv_upstream_bytes_received_total", "Response bytes received from upstream")
+PAGES_FETCHED = Counter("dvv_upstream_pages_total", "Upstream pages fetched and stored")
+RECORDS = Counter("dvv_upstream_records_total", "Upstream records kept or discarded while storing", ("outcome",))
+EXPORTED_RECORDS = Counter("dvv_export_records_total", "Records exported", ("format",))
+
+
+# Start collecting the stage durations of the current request
+def track_request():
+    timings = {}
+    request_timings.set(timings)
+    return timings
+
+
+def record_stage(name: str, seconds: float):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    timings = request_timings.get()
+    if timings is not None:
+        timings[name] = timings.get(name, 0.0) + seconds
+
+
+@contextmanager
+def stage(name: str):
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(name, time.perf_counter() - started)
+
+
+def timed(name: str):
+    def decorate(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+# Pass the chunks of a streamed response through, observing the time spent producing
+# them (not sending them) as one stage when the stream ends
+async def timed_stream(name: str, chunks):
+    iterator = chunks.__aiter__()
+    seconds = 0.0
+    try:
+        while True:
+            started = time.perf_counter()
+            try:
+                chunk = await iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            finally:
+                seconds += time.perf_counter() - started
+            yield chunk
+    finally:
+        record_stage(name, seconds)
+
+
+# Server-Timing header value of the stage durations and the total so far
+def server_timing(timings: dict, total: float):
+    entries = [f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items()]
+    return ", ".join(entries + [f"total;dur={total * 1000:.1f}"])
+
+
+def render():
+    lines = []
+    for metric in _metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+# ASGI middleware counting requests, response bytes and durations per route, and adding
+# the Server-Timing header
+class MetricsMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        timings = track_request()
+        response = {"status": 500, "bytes": 0}
+
+        async def send_with_metrics(message):
+            if message["type"] == "http.response.start":
+                response["status"] = message["status"]
+                if SERVER_TIMING:
+                    message["headers"] = list(message.get("headers", [])) + [
+                        (b"server-timing", server_timing(timings, time.perf_counter() - started).encode()),
+                        (b"timing-allow-origin", TIMING_ALLOW_ORIGIN.encode()),
+                    ]
+            elif message["type"] == "http.response.body":
+                response["bytes"] += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            route = scope.get("route")
+            path = getattr(route, "path", "other")
+            HTTP_REQUESTS.inc(path=path, status=response["status"])
+            HTTP_SECONDS.observe(time.perf_counter() - started, path=path)
+            HTTP_BYTES_SENT.inc(response["bytes"], path=path)
@@ -0,0 +1,240 @@
+import asyncio
+import json
+import numpy as np
+import store
+from calibration import CalibrationPlan
+from frames import property_matrix, to_list
+from timestamps import epoch_to_iso
+
+# Hourly and daily aggregates of the stored records, kept up to date as pages are stored.
+#
+# Every bucket keeps, per channel, the count, sum, min and max of the raw (uncalibrated)
+# values and the first and last reading, packed as a (ROLLUP_STATS x channels) float64
+# array. Calibration is applied when the rollups are read, so a change to
+# calibration.json never requires rebuilding them: the means, mins and maxes follow the
+# affine calibration directly, and energy deltas of the cumulative counters only scale.
+
+# Channels aggregated in the rollups; the stored arrays depend on this order
+ROLLUP_CHANNELS = [
+    "V1_Voltage", "V2_Voltage", "V3_Voltage",
+    "I1_Current", "I2_Current", "I3_Current",
+    "KW_L1", "KW_L2", "KW_L3",
+    "Kvar_L1", "Kvar_L2", "Kvar_L3",
+    "KVA_L1", "KVA_L2", "KVA_L3",
+    "PF_L1", "PF_L2", "PF_L3",
+    "Total_Kvar", "Total_KVA", "Total_PF",
+    "Frequency", "Kwh_Import", "KVAh_import",
+]
+
+# Cumulative energy counters, reported as the energy delta of each bucket
+ENERGY_CHANNELS = ["Kwh_Import", "KVAh_import"]
+
+# Rows of the per-bucket stats array
+COUNT, SUM, MIN, MAX, FIRST, LAST = range(6)
+ROLLUP_STATS = 6
+
+HOUR_MS = 3600 * 1000
+DAY_MS = 24 * HOUR_MS
+
+# Days of stored records aggregated at a time when the rollups of a device are rebuilt
+REBUILD_CHUNK_MS = 7 * DAY_MS
+
+
+# Index of the first and of the last row holding a value in each group of rows (groups
+# begin at `starts`), per column. A group without values gets len(present) and -1, which
+# both select the NaN padding row of pad_rows().
+def first_last_rows(present: np.ndarray, starts: np.ndarray):
+    rows = np.arange(len(present))[:, None]
+    firsts = np.minimum.reduceat(np.where(present, rows, len(present)), starts, axis=0)
+    lasts = np.maximum.reduceat(np.where(present, rows, -1), starts, axis=0)
+    return firsts, lasts
+
+
+def pad_rows(values: np.ndarray):
+    return np.vstack([values, np.full((1, values.shape[1]), np.nan)])
+
+
+def bucket_starts(epochs: np.ndarray, bucket_ms: int):
+    bucket_ids = epochs // bucket_ms
+    return np.flatnonzero(np.r_[True, bucket_ids[1:] != bucket_ids[:-1]]), bucket_ids
+
+
+# Aggregate chronological samples (epochs and a values matrix) into buckets of bucket_ms.
+# Returns the bucket start epochs, the samples per bucket and the stats arrays.
+def aggregate_samples(epochs: np.ndarray, values: np.ndarray, bucket_ms: int):
+    starts, bucket_ids = bucket_starts(epochs, bucket_ms)
+    present = ~np.isnan(values)
+    columns = np.arange(values.shape[1])
+    firsts, lasts = first_last_rows(present, starts)
+    padded = pad_rows(values)
+
+    stats = np.stack([
+        np.add.reduceat(present, starts, axis=0).astype(float),
+        np.add.reduceat(np.where(present, values, 0.0), starts, axis=0),
+        np.fmin.reduceat(values, starts, axis=0),
+        np.fmax.reduceat(values, starts, axis=0),
+        padded[firsts, columns],
+        padded[lasts, columns],
+    ], axis=1)
+    samples = np.diff(np.r_[starts, len(epochs)])
+    return bucket_ids[starts] * bucket_ms, samples, stats
+
+
+# Combine chronological buckets into coarser buckets of bucket_ms
+def combine_buckets(buckets: np.ndarray, samples: np.ndarray, stats: np.ndarray, bucket_ms: int):
+    starts, bucket_ids = bucket_starts(buckets, bucket_ms)
+    columns = np.arange(stats.shape[2])
+    firsts, _ = first_last_rows(~np.isnan(stats[:, FIRST]), starts)
+    _, lasts = first_last_rows(~np.isnan(stats[:, LAST]), starts)
+
+    combined = np.stack([
+        np.add.reduceat(stats[:, COUNT], starts, axis=0),
+        np.add.reduceat(stats[:, SUM], starts, axis=0),
+        np.fmin.reduceat(stats[:, MIN], starts, axis=0),
+        np.fmax.reduceat(stats[:, MAX], starts, axis=0),
+        pad_rows(stats[:, FIRST])[firsts, columns],
+        pad_rows(stats[:, LAST])[lasts, columns],
+    ], axis=1)
+    return bucket_ids[starts] * bucket_ms, np.add.reduceat(samples, starts), combined
+
+
+# Hourly buckets of a page of records, given their epochs and property dicts
+def aggregate_page(epochs: list, page_properties: list):
+    order = np.argsort(np.array(epochs, dtype=np.int64), kind="stable")
+    values = property_matrix(page_properties, ROLLUP_CHANNELS)[order]
+    return aggregate_samples(np.array(epochs, dtype=np.int64)[order], values, HOUR_MS)
+
+
+# Hourly buckets of stored (epoch, record JSON) rows in chronological order
+def aggregate_rows(rows: list):
+    return aggregate_page(
+        [epoch for epoch, _ in rows], [json.loads(record).get("property", {}) for _, record in rows]
+    )
+
+
+def rollup_rows(buckets: np.ndarray, samples: np.ndarray, stats: np.ndarray):
+    return [
+        (bucket, count, bucket_stats.tobytes())
+        for bucket, count, bucket_stats in zip(buckets.tolist(), samples.tolist(), stats)
+    ]
+
+
+def load_rollups(rows: list):
+    buckets = np.array([bucket for bucket, _, _ in rows], dtype=np.int64)
+    samples = np.array([count for _, count, _ in rows], dtype=np.int64)
+    stats = np.frombuffer(b"".join(blob for _, _, blob in rows)).reshape(len(rows), ROLLUP_STATS, len(ROLLUP_CHANNELS))
+    return buckets, samples, stats
+
+
+# Recompute the hourly rollups of the whole hours overlapping [start, end] from the
+# stored records. Recomputing rather than adding to the stored aggregates keeps them
+# exact when records overlap the ones stored before.
+async def rollup_hours(device_serial: str, start: int, end: int):
+    rows = store.get_record_rows(device_serial, start // HOUR_MS * HOUR_MS, end // HOUR_MS * HOUR_MS + HOUR_MS)
+    if rows:
+        # Decoding the records is the costly part; keep it off the event loop
+        hourly = await asyncio.to_thread(aggregate_rows, rows)
+        await store.run(store.add_rollups, device_serial, "hour", rollup_rows(*hourly))
+
+
+# Recompute the daily rollups of the whole days overlapping [start, end] from the hourly ones
+async def rollup_days(device_serial: str, start: int, end: int):
+    rows = store.get_rollups(device_serial, "hour", start // DAY_MS * DAY_MS, end // DAY_MS * DAY_MS + DAY_MS)
+    if rows:
+        days = combine_buckets(*load_rollups(rows), DAY_MS)
+        await store.run(store.add_rollups, device_serial, "day", rollup_rows(*days))
+
+
+# Build the rollups of every stored record of a device, once per device
+async def ensure_rollups(device_serial: str):
+    if store.has_rollups(device_serial):
+        return
+    span = store.get_record_span(device_serial)
+    if span:
+        oldest, newest = span
+        for chunk_start in range(oldest // DAY_MS * DAY_MS, newest + 1, REBUILD_CHUNK_MS):
+            chunk_end = min(chunk_start + REBUILD_CHUNK_MS, newest + 1) - 1
+            await rollup_hours(device_serial, chunk_start, chunk_end)
+            await rollup_days(device_serial, chunk_start, chunk_end)
+    await store.run(store.set_has_rollups, device_serial)
+
+
+# Bring the rollups up to date after a page was stored, given the hourly buckets of the
+# page from aggregate_page. A page holds a contiguous run of the device's records, so
+# every hour strictly inside it is complete and stored as is; only the first and last
+# hour, which may continue into other pages, are recomputed from the store.
+async def update_rollups(device_serial: str, buckets: np.ndarray, samples: np.ndarray, stats: np.ndarray):
+    if not store.has_rollups(device_serial):
+        await ensure_rollups(device_serial)
+        return
+
+    await store.run(store.add_rollups, device_serial, "hour", rollup_rows(buckets[1:-1], samples[1:-1], stats[1:-1]))
+    await rollup_hours(device_serial, int(buckets[0]), int(buckets[0]))
+    if len(buckets) > 1:
+        await rollup_hours(device_serial, int(buckets[-1]), int(buckets[-1]))
+    await rollup_days(device_serial, int(buckets[0]), int(buckets[-1]))
+
+
+# Energy used in each bucket from the readings of a cumulative counter: the last reading
+# minus the last reading of the preceding bucket that has one (seed for the first
+# bucket), or minus the bucket's own first reading when there is none or the counter
+# went backwards (a meter reset). Energy used during gaps is counted in the next bucket.
+def counter_deltas(firsts: np.ndarray, lasts: np.ndarray, seed: float):
+    held = np.maximum.accumulate(np.where(np.isnan(lasts), -1, np.arange(len(lasts))))
+    previous = np.r_[seed, np.append(lasts, np.nan)[held[:-1]]]
+    deltas = lasts - previous
+    with np.errstate(invalid="ignore"):
+        reset = np.isnan(previous) | (deltas < 0)
+    return np.where(reset, lasts - firsts, deltas)
+
+
+# Per-channel divisors, multipliers and offsets of a calibration plan
+def calibration_arrays(plan: CalibrationPlan):
+    divisors = np.ones(len(ROLLUP_CHANNELS))
+    multipliers = np.ones(len(ROLLUP_CHANNELS))
+    offsets = np.zeros(len(ROLLUP_CHANNELS))
+    for key, divisor, multiplier, offset in zip(plan.keys, plan.divisors, plan.multipliers, plan.offsets):
+        if key in ROLLUP_CHANNELS:
+            column = ROLLUP_CHANNELS.index(key)
+            divisors[column], multipliers[column], offsets[column] = divisor, multiplier, offset
+    return divisors, multipliers, offsets
+
+
+# Calibrated rollups of a device with start <= bucket < end in chronological order:
+# the bucket starts and sample counts, the energy delta of each counter and the min,
+# max and mean of every other channel, for the channels with values in the range
+def read_rollups(device_serial: str, resolution: str, start: int, end: int, plan: CalibrationPlan, epoch_timestamps: bool = False):
+    rows = store.get_rollups(device_serial, resolution, start, end)
+    buckets, samples, stats = load_rollups(rows)
+    divisors, multipliers, offsets = calibration_arrays(plan)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.where(stats[:, COUNT] > 0, stats[:, SUM] / stats[:, COUNT], np.nan)
+    scaled_means = means / divisors * multipliers + offsets
+    # A negative calibration factor swaps the min and the max
+    scaled_mins = stats[:, MIN] / divisors * multipliers + offsets
+    scaled_maxs = stats[:, MAX] / divisors * multipliers + offsets
+
+    previous = store.get_rollups_before(device_serial, resolution, start)
+    seeds = load_rollups([previous])[2][0, LAST] if previous else np.full(len(ROLLUP_CHANNELS), np.nan)
+
+    energy, series = {}, {}
+    for column, key in enumerate(ROLLUP_CHANNELS):
+        if not stats[:, COUNT, column].any():
+            continue
+        if key in ENERGY_CHANNELS:
+            deltas = counter_deltas(stats[:, FIRST, column], stats[:, LAST, column], seeds[column])
+            energy[key] = to_list(deltas / divisors[column] * multipliers[column])
+        else:
+            series[key] = {
+                "min": to_list(np.fmin(scaled_mins[:, column], scaled_maxs[:, column])),
+                "max": to_list(np.fmax(scaled_mins[:, column], scaled_maxs[:, column])),
+                "mean": to_list(scaled_means[:, column]),
+            }
+
+    return {
+        "buckets": buckets.tolist() if epoch_timestamps else [epoch_to_iso(bucket) for bucket in buckets.tolist()],
+        "samples": samples.tolist(),
+        "energy": energy,
+        "series": series,
+    }
@@ -0,0 +1,335 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Local time-series cache of upstream records.
+#
+# Every record seen while paging the upstream API is kept here, keyed by device
+# serial and created_at (as epoch milliseconds). The `segments` table remembers
+# which stretches of each device's history have been paged contiguously, together
+# with the page token needed to continue paging further back from that stretch.
+# While seeking is enabled, the `page_index` table maps page tokens seen while paging
+# to the created_at (as epoch milliseconds) at which paging from that token starts, so
+# that old dates can be reached without paging through everything newer first. Devices whose upstream
+# rejected a synthesized token are listed in `seek_disabled_devices` and always paged.
+#
+# Several worker processes may share one store: it runs in WAL mode, so they read while
+# another one writes. The `leases` table holds named locks across the processes and the
+# `results` table short-lived results they share (see coalesce.ResultCache).
+
+# Several worker processes (uvicorn --workers) share the store
+MULTI_WORKER = os.getenv("MULTI_WORKER", "false").lower() == "true"
+
+# Connection of each thread, so that calls made through run() keep their transactions apart
+_local = threading.local()
+
+
+def get_connection():
+    connection = getattr(_local, "connection", None)
+    if connection is None:
+        connection = _local.connection = sqlite3.connect(os.getenv("STORE_PATH", "records.db"))
+        connection.executescript(
+            """
+            PRAGMA journal_mode = WAL;
+            PRAGMA synchronous = NORMAL;
+
+            CREATE TABLE IF NOT EXISTS records (
+                device_serial TEXT NOT NULL,
+                epoch INTEGER NOT NULL,
+                created_at TEXT NOT NULL,
+                record TEXT NOT NULL,
+                PRIMARY KEY (device_serial, epoch)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS segments (
+                device_serial TEXT NOT NULL,
+                oldest INTEGER NOT NULL,
+                newest INTEGER NOT NULL,
+                resume_token TEXT
+            );
+            CREATE INDEX IF NOT EXISTS segments_device ON segments (device_serial, newest);
+
+            CREATE TABLE IF NOT EXISTS page_index (
+                device_serial TEXT NOT NULL,
+                token TEXT NOT NULL,
+                epoch INTEGER NOT NULL,
+                PRIMARY KEY (device_serial, token)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS seek_disabled_devices (
+                device_serial TEXT PRIMARY KEY
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS rollups (
+                device_serial TEXT NOT NULL,
+                resolution TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                samples INTEGER NOT NULL,
+                stats BLOB NOT NULL,
+                PRIMARY KEY (device_serial, resolution, bucket)
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS rollup_devices (
+                device_serial TEXT PRIMARY KEY
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                expires REAL NOT NULL
+            ) WITHOUT ROWID;
+
+            CREATE TABLE IF NOT EXISTS results (
+                name TEXT NOT NULL,
+                key TEXT NOT NULL,
+                expires REAL NOT NULL,
+                value BLOB NOT NULL,
+                PRIMARY KEY (name, key)
+            ) WITHOUT ROWID;
+            """
+        )
+    return connection
+
+
+# Call a store function from the event loop. With MULTI_WORKER a write may wait for the
+# write lock of another process for up to the busy timeout (5 seconds), so the call runs
+# in a thread; otherwise it runs inline.
+async def run(function, *args, **kwargs):
+    if MULTI_WORKER:
+        return await asyncio.to_thread(function, *args, **kwargs)
+    return function(*args, **kwargs)
+
+
+# Insert (epoch, created_at, record JSON) rows, ignoring records that are already stored,
+# and (token, epoch, estimate) page positions (see insert_page_position) in one transaction
+def add_records(device_serial: str, rows: list, page_positions: list = ()):
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            "INSERT OR IGNORE INTO records (device_serial, epoch, created_at, record) VALUES (?, ?, ?, ?)",
+            [(device_serial, epoch, created_at, record) for epoch, created_at, record in rows],
+        )
+        for token, epoch, estimate in page_positions:
+            insert_page_position(connection, device_serial, token, epoch, estimate)
+
+
+# Decode a stored record, carrying its parsed created_at along as record["epoch"]
+def load_record(epoch: int, record: str):
+    record = json.loads(record)
+    record["epoch"] = epoch
+    return record
+
+
+# Return the newest page_size stored records with start <= epoch < end, newest first,
+# and the end of the page below (None when there is none)
+def get_record_page(device_serial: str, start: int, end: int, page_size: int = 1000):
+    rows = get_connection().execute(
+        "SELECT epoch, record FROM records WHERE device_serial = ? AND epoch >= ? AND epoch < ?"
+        " ORDER BY epoch DESC LIMIT ?",
+        (device_serial, start, end, page_size),
+    ).fetchall()
+    next_end = rows[-1][0] if len(rows) == page_size else None
+    return [load_record(epoch, record) for epoch, record in rows], next_end
+
+
+# Yield stored records with start <= epoch < end, newest first, page_size records at a time.
+# Every page is a query of its own, so no read stays open on the shared connection while
+# the caller awaits between pages; an open read would make the writes of this process
+# fail while another worker process writes.
+def iter_records(device_serial: str, start: int, end: int, page_size: int = 1000):
+    while end is not None:
+        records, end = get_record_page(device_serial, start, end, page_size)
+        if records:
+            yield records
+
+
+# Return the stored (epoch, record JSON) rows with start <= epoch < end, oldest first
+def get_record_rows(device_serial: str, start: int, end: int):
+    return get_connection().execute(
+        "SELECT epoch, record FROM records WHERE device_serial = ? AND epoch >= ? AND epoch < ? ORDER BY epoch",
+        (device_serial, start, end),
+    ).fetchall()
+
+
+# Return the oldest and newest stored epoch of a device, or None without stored records
+def get_record_span(device_serial: str):
+    row = get_connection().execute(
+        "SELECT MIN(epoch), MAX(epoch) FROM records WHERE device_serial = ?",
+        (device_serial,),
+    ).fetchone()
+    return row if row[0] is not None else None
+
+
+def get_latest_record(device_serial: str):
+    row = get_connection().execute(
+        "SELECT epoch, record FROM records WHERE device_serial = ? ORDER BY epoch DESC LIMIT 1",
+        (device_serial,),
+    ).fetchone()
+    return load_record(*row) if row else None
+
+
+# Return the contiguously paged segments of a device as dicts, newest first
+def get_segments(device_serial: str):
+    rows = get_connection().execute(
+        "SELECT rowid, oldest, newest, resume_token FROM segments WHERE device_serial = ? ORDER BY newest DESC",
+        (device_serial,),
+    )
+    return [
+        {
+            "id": rowid,
+            "oldest": oldest,
+            "newest": newest,
+            "resume_token": json.loads(resume_token) if resume_token else None,
+        }
+        for rowid, oldest, newest, resume_token in rows
+    ]
+
+
+# Record that [oldest, newest] was paged contiguously and that resume_token continues
+# below oldest. Overlapping segments, and the segment the walk continued from
+# (`extends`), are merged into a single segment. The segments are read and replaced in
+# one write transaction, so another worker process cannot change them in between.
+def add_segment(device_serial: str, oldest: int, newest: int, resume_token, extends: dict = None):
+    connection = get_connection()
+    with connection:
+        connection.execute("BEGIN IMMEDIATE")
+        merged = [
+            segment for segment in get_segments(device_serial)
+            if segment["oldest"] <= newest and segment["newest"] >= oldest
+            or (extends and segment["id"] == extends["id"])
+        ]
+
+        lowest = min(merged, key=lambda segment: segment["oldest"], default=None)
+        if lowest and lowest["oldest"] < oldest:
+            oldest = lowest["oldest"]
+            resume_token = lowest["resume_token"]
+        newest = max([newest] + [segment["newest"] for segment in merged])
+
+        connection.executemany("DELETE FROM segments WHERE rowid = ?", [(segment["id"],) for segment in merged])
+        connection.execute(
+            "INSERT INTO segments (device_serial, oldest, newest, resume_token) VALUES (?, ?, ?, ?)",
+            (device_serial, oldest, newest, json.dumps(resume_token) if resume_token else None),
+        )
+
+
+def set_resume_token(segment: dict, resume_token):
+    connection = get_connection()
+    with connection:
+        connection.execute(
+            "UPDATE segments SET resume_token = ? WHERE rowid = ?",
+            (json.dumps(resume_token) if resume_token else None, segment["id"]),
+        )
+
+
+# Remember the epoch at which paging from token starts, within the caller's transaction.
+# An estimate never replaces a position that was already recorded.
+def insert_page_position(connection: sqlite3.Connection, device_serial: str, token, epoch: int, estimate: bool = False):
+    connection.execute(
+        f"INSERT OR {'IGNORE' if estimate else 'REPLACE'} INTO page_index (device_serial, token, epoch) VALUES (?, ?, ?)",
+        (device_serial, json.dumps(token, sort_keys=True), epoch),
+    )
+
+
+# Return the indexed (token, epoch) pairs of a device, newest first
+def get_page_positions(device_serial: str):
+    rows = get_connection().execute(
+        "SELECT token, epoch FROM page_index WHERE device_serial = ? ORDER BY epoch DESC",
+        (device_serial,),
+    )
+    return [(json.loads(token), epoch) for token, epoch in rows]
+
+
+# Whether seeking with synthesized page tokens was turned off for a device
+def seek_disabled(device_serial: str):
+    return get_connection().execute(
+        "SELECT 1 FROM seek_disabled_devices WHERE device_serial = ?", (device_serial,)
+    ).fetchone() is not None
+
+
+def disable_seek(device_serial: str):
+    connection = get_connection()
+    with connection:
+        connection.execute("INSERT OR IGNORE INTO seek_disabled_devices (device_serial) VALUES (?)", (device_serial,))
+
+
+# Insert or replace (bucket, samples, stats) rollup rows of one resolution
+def add_rollups(device_serial: str, resolution: str, rows: list):
+    connection = get_connection()
+    with connection:
+        connection.executemany(
+            "INSERT OR REPLACE INTO rollups (device_serial, resolution, bucket, samples, stats) VALUES (?, ?, ?, ?, ?)",
+            [(device_serial, resolution, bucket, samples, stats) for bucket, samples, stats in rows],
+        )
+
+
+# Return the (bucket, samples, stats) rollup rows with start <= bucket < end, oldest first
+def get_rollups(device_serial: str, resolution: str, start: int, end: int):
+    return get_connection().execute(
+        "SELECT bucket, samples, stats FROM rollups"
+        " WHERE device_serial = ? AND resolution = ? AND bucket >= ? AND bucket < ? ORDER BY bucket",
+        (device_serial, resolution, start, end),
+    ).fetchall()
+
+
+# Return the last rollup row before start, or None
+def get_rollups_before(device_serial: str, resolution: str, start: int):
+    return get_connection().execute(
+        "SELECT bucket, samples, stats FROM rollups"
+        " WHERE device_serial = ? AND resolution = ? AND bucket < ? ORDER BY bucket DESC LIMIT 1",
+        (device_serial, resolution, start),
+    ).fetchone()
+
+
+# Whether the rollups of a device cover all of its stored records
+def has_rollups(device_serial: str):
+    return get_connection().execute(
+        "SELECT 1 FROM rollup_devices WHERE device_serial = ?", (device_serial,)
+    ).fetchone() is not None
+
+
+def set_has_rollups(device_serial: str):
+    connection = get_connection()
+    with connection:
+        connection.execute("INSERT OR IGNORE INTO rollup_devices (device_serial) VALUES (?)", (device_serial,))
+
+
+# Take or renew the lease `name` for owner until `expires` (a Unix time). Returns False
+# while another owner holds an unexpired lease.
+def acquire_lease(name: str, owner: str, expires: float):
+    connection = get_connection()
+    with connection:
+        cursor = connection.execute(
+            "INSERT INTO leases (name, owner, expires) VALUES (?, ?, ?)"
+            " ON CONFLICT (name) DO UPDATE SET owner = excluded.owner, expires = excluded.expires"
+            " WHERE leases.owner = excluded.owner OR leases.expires < ?",
+            (name, owner, expires, time.time()),
+        )
+    return cursor.rowcount > 0
+
+
+def release_lease(name: str, owner: str):
+    connection = get_connection()
+    with connection:
+        connection.execute("DELETE FROM leases WHERE name = ? AND owner = ?", (name, owner))
+
+
+# Return the shared result stored under (name, key), or None when missing or expired
+def get_result(name: str, key: str):
+    row = get_connection().execute(
+        "SELECT value FROM results WHERE name = ? AND key = ? AND expires > ?", (name, key, time.time())
+    ).fetchone()
+    return row[0] if row else None
+
+
+# Store a shared result until `expires` (a Unix time), dropping the expired ones
+def add_result(name: str, key: str, value: bytes, expires: float):
+    connection = get_connection()
+    with connection:
+        connection.execute("DELETE FROM results WHERE expires <= ?", (time.time(),))
+        connection.execute(
+            "INSERT OR REPLACE INTO results (name, key, expires, value) VALUES (?, ?, ?, ?)",
+            (name, key, expires, value),
+        )
@@ -0,0 +1,38 @@
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from downsample import downsample_frame  # noqa: E402
+from frames import frame_from_records, frame_length  # noqa: E402
+from timestamps import epoch_to_iso  # noqa: E402
+
+
+# Records newest first, one every interval seconds from an unaligned start epoch
+def make_frame(count: int, start: int, interval: int):
+    epochs = [start + index * interval * 1000 for index in range(count)][::-1]
+    return frame_from_records([
+        {"epoch": epoch, "created_at": epoch_to_iso(epoch), "property": {"V1_Voltage": 230.0 + index % 7}}
+        for index, epoch in enumerate(epochs)
+    ])
+
+
+def test_minmax_never_exceeds_max_points():
+    generator = random.Random(0)
+    for _ in range(200):
+        count = generator.randint(3, 2000)
+        frame = make_frame(count, 1730851200000 + generator.randint(1, 86399999), 60)
+        max_points = generator.randint(3, 300)
+        # Resolutions around the bucket width max_points needs, where aligned buckets are kept
+        resolution = generator.choice([None, max(1, int(count * 60 / max_points * generator.uniform(0.8, 1.5)))])
+        downsampled, _ = downsample_frame(frame, max_points=max_points, resolution=resolution)
+        assert frame_length(downsampled) <= max_points
+
+
+def test_aligned_buckets_at_max_points():
+    # 100 hours starting mid-hour straddle 101 aligned hourly buckets
+    frame = make_frame(6000, 1730851200000 + 1800 * 1000, 60)
+    downsampled, summary = downsample_frame(frame, max_points=100, resolution=3600)
+    assert frame_length(downsampled) <= 100
+    assert summary["bucket_seconds"] % 3600 == 0
@@ -0,0 +1,169 @@
+import numpy as np
+import store
+from typing import NamedTuple
+from calibration import CalibrationPlan, scale_frame
+from frames import RecordFrame, frame_from_records, frame_matrix
+from timestamps import epoch_to_iso
+
+# Calibrated property checked against each pair of limits in thresholds.json, and the
+# paths of its high and low limit
+THRESHOLD_FIELDS = {
+    "V1_Voltage": (("voltage", "VL1", "V1H"), ("voltage", "VL1", "V1L")),
+    "V2_Voltage": (("voltage", "VL2", "V2H"), ("voltage", "VL2", "V2L")),
+    "V3_Voltage": (("voltage", "VL3", "V3H"), ("voltage", "VL3", "V3L")),
+    "I1_Current": (("current", "IR1", "I1H"), ("current", "IR1", "I1L")),
+    "I2_Current": (("current", "IR2", "I2H"), ("current", "IR2", "I2L")),
+    "I3_Current": (("current", "IR3", "I3H"), ("current", "IR3", "I3L")),
+    "KW_L1": (("power", "KW", "PW1", "L1H"), ("power", "KW", "PW1", "L1L")),
+    "KW_L2": (("power", "KW", "PW2", "L2H"), ("power", "KW", "PW2", "L2L")),
+    "KW_L3": (("power", "KW", "PW3", "L3H"), ("power", "KW", "PW3", "L3L")),
+    "Kvar_L1": (("power", "Kvar", "Kvar1", "L1H"), ("power", "Kvar", "Kvar1", "L1L")),
+    "Kvar_L2": (("power", "Kvar", "Kvar2", "L2H"), ("power", "Kvar", "Kvar2", "L2L")),
+    "Kvar_L3": (("power", "Kvar", "Kvar3", "L3H"), ("power", "Kvar", "Kvar3", "L3L")),
+    "KVA_L1": (("power", "KVA", "KVA1", "L1H"), ("power", "KVA", "KVA1", "L1L")),
+    "KVA_L2": (("power", "KVA", "KVA2", "L2H"), ("power", "KVA", "KVA2", "L2L")),
+    "KVA_L3": (("power", "KVA", "KVA3", "L3H"), ("power", "KVA", "KVA3", "L3L")),
+    "PF_L1": (("power", "PF", "PF1", "L1H"), ("power", "PF", "PF1", "L1L")),
+    "PF_L2": (("power", "PF", "PF2", "L2H"), ("power", "PF", "PF2", "L2L")),
+    "PF_L3": (("power", "PF", "PF3", "L3H"), ("power", "PF", "PF3", "L3L")),
+    "Frequency": (("Frequency", "FreqH"), ("Frequency", "FreqL")),
+}
+
+# Most recent violation intervals reported per channel
+MAX_INTERVALS = 100
+
+
+# thresholds.json compiled for evaluation: the checked property keys and, per key, the
+# high and low limit (NaN when not configured) and their names
+class ThresholdPlan(NamedTuple):
+    keys: list
+    highs: np.ndarray
+    lows: np.ndarray
+    high_names: list
+    low_names: list
+
+
+def threshold_value(threshold_values: dict, path: tuple):
+    value = threshold_values
+    for name in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(name)
+    return value if isinstance(value, (int, float)) else None
+
+
+def compile_thresholds(threshold_values: dict):
+    keys, highs, lows = [], [], []
+    for key, (high_path, low_path) in THRESHOLD_FIELDS.items():
+        high = threshold_value(threshold_values, high_path)
+        low = threshold_value(threshold_values, low_path)
+        if high is None and low is None:
+            continue
+        keys.append(key)
+        highs.append(np.nan if high is None else high)
+        lows.append(np.nan if low is None else low)
+
+    return ThresholdPlan(
+        keys,
+        np.array(highs, dtype=float),
+        np.array(lows, dtype=float),
+        [THRESHOLD_FIELDS[key][0][-1] for key in keys],
+        [THRESHOLD_FIELDS[key][1][-1] for key in keys],
+    )
+
+
+# Matrix of the checked values of a calibrated record frame
+def threshold_matrix(plan: ThresholdPlan, frame: RecordFrame):
+    return frame_matrix(frame, plan.keys)
+
+
+# Runs of consecutive True values in each column of a boolean matrix, as the column,
+# first row and row after the last of every run, ordered by column and then row
+def runs(mask: np.ndarray):
+    padded = np.zeros((mask.shape[1], mask.shape[0] + 2), dtype=np.int8)
+    padded[:, 1:-1] = mask.T
+    edges = np.diff(padded, axis=1)
+    columns, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+    return columns, starts, ends
+
+
+# Evaluate the limits over calibrated values in chronological order (epochs and a
+# matching values matrix from threshold_matrix) in one vectorized pass. Returns the
+# number of samples and of samples violating a limit on any channel, and per channel
+# with violations its number of violating samples and most recent violation intervals
+# (newest first), each with its start and end, the peak value and the limit crossed.
+def evaluate_thresholds(plan: ThresholdPlan, epochs: np.ndarray, values: np.ndarray, max_intervals: int = MAX_INTERVALS):
+    samples = len(epochs)
+    channels = {}
+    if not plan.keys or not samples:
+        return {"samples": samples, "count": 0, "channels": channels}
+
+    with np.errstate(invalid="ignore"):
+        high = values > plan.highs
+        low = values < plan.lows
+
+    # Column-major values with one padding element, so the peak of every run can be
+    # reduced in one call
+    flat = np.append(values.T.ravel(), np.nan)
+
+    intervals = [[] for _ in plan.keys]
+    for mask, reduce, limits, names in (
+        (high, np.fmax, plan.highs, plan.high_names),
+        (low, np.fmin, plan.lows, plan.low_names),
+    ):
+        columns, starts, ends = runs(mask)
+        if not len(columns):
+            continue
+
+        bounds = np.column_stack([columns * samples + starts, columns * samples + ends]).ravel()
+        peaks = reduce.reduceat(flat, bounds)[::2]
+
+        for column, start, end, peak in zip(columns.tolist(), starts.tolist(), ends.tolist(), peaks.tolist()):
+            intervals[column].append((start, {
+                "start": epoch_to_iso(int(epochs[start])),
+                "end": epoch_to_iso(int(epochs[end - 1])),
+                "peak": peak,
+                "limit": names[column],
+                "threshold": float(limits[column]),
+                "samples": end - start,
+            }))
+
+    violating = high | low
+    counts = violating.sum(axis=0)
+    for column, key in enumerate(plan.keys):
+        if not counts[column]:
+            continue
+        newest_first = sorted(intervals[column], key=lambda interval: interval[0], reverse=True)
+        channels[key] = {
+            "count": int(counts[column]),
+            "intervals": [interval for _, interval in newest_first[:max_intervals]],
+        }
+
+    return {"samples": samples, "count": int(violating.any(axis=1).sum()), "channels": channels}
+
+
+# Evaluate the limits over a calibrated record frame (newest first)
+def evaluate_frame(plan: ThresholdPlan, frame: RecordFrame, max_intervals: int = MAX_INTERVALS):
+    return evaluate_thresholds(plan, frame.epochs[::-1], threshold_matrix(plan, frame)[::-1], max_intervals)
+
+
+# Evaluate the limits over pages of uncalibrated records (newest first), calibrating one
+# page at a time and keeping only the checked values of each page
+def evaluate_pages(plan: ThresholdPlan, calibration_plan: CalibrationPlan, pages, max_intervals: int = MAX_INTERVALS):
+    epochs = [np.empty(0, dtype=np.int64)]
+    values = [np.empty((0, len(plan.keys)))]
+    for page in pages:
+        frame = scale_frame(calibration_plan, frame_from_records(page))
+        epochs.append(frame.epochs[::-1])
+        values.append(threshold_matrix(plan, frame)[::-1])
+
+    return evaluate_thresholds(plan, np.concatenate(epochs[::-1]), np.concatenate(values[::-1]), max_intervals)
+
+
+# Evaluate the limits over the stored records of a device in the [start, end) window.
+# Run through workers.run, so the records are read and decoded in the process pool too.
+def evaluate_range(
+        plan: ThresholdPlan, calibration_plan: CalibrationPlan, device_serial: str, window: tuple,
+        max_intervals: int = MAX_INTERVALS):
+    return evaluate_pages(plan, calibration_plan, store.iter_records(device_serial, *window), max_intervals)
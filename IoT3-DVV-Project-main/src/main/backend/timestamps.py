@@ -0,0 +1,69 @@
+from datetime import datetime, timezone
+import numpy as np
+
+# Shared handling of record timestamps.
+#
+# created_at is parsed into epoch milliseconds once, when a page is stored, and every
+# record read back from the store carries it as record["epoch"]. Date filtering works on
+# these integers, and timestamps are only formatted back into strings at the edge, when
+# a response or an export is built.
+
+NAT = np.iinfo(np.int64).min
+
+
+# Parse a created_at timestamp into epoch milliseconds
+def parse_created_at(created_at: str):
+    if created_at.endswith('+00:0'):
+        created_at = created_at[:-1] + '00'
+    return int(datetime.fromisoformat(created_at.replace("Z", "+00:00")).timestamp() * 1000)
+
+
+# Parse a list of created_at timestamps into an int64 array of epoch milliseconds.
+# UTC timestamps ('Z', '+00:00' and the truncated '+00:0' sent by the API) are parsed
+# by NumPy in one pass; other offsets fall back to parse_created_at. Raises ValueError
+# for a timestamp that cannot be parsed.
+def parse_timestamps(values: list):
+    local = [
+        value[:-6] if value.endswith("+00:00")
+        else value[:-1] if value.endswith("Z")
+        else value[:-5] if value.endswith("+00:0")
+        else "NaT"
+        for value in values
+    ]
+    epochs = np.array(local, dtype="datetime64[ms]").astype(np.int64)
+    for index in np.flatnonzero(epochs == NAT).tolist():
+        epochs[index] = parse_created_at(values[index])
+    return epochs
+
+
+# Epoch milliseconds of each record: the stored epoch when present, otherwise parsed from
+# created_at. Records without a timestamp get NAT.
+def record_epochs(records: list):
+    try:
+        return np.fromiter((record["epoch"] for record in records), dtype=np.int64, count=len(records))
+    except (KeyError, TypeError):
+        pass
+
+    epochs = np.full(len(records), NAT, dtype=np.int64)
+    missing = []
+    for index, record in enumerate(records):
+        epoch = record.get("epoch")
+        if epoch is not None:
+            epochs[index] = epoch
+        elif record.get("created_at"):
+            missing.append(index)
+    if missing:
+        epochs[missing] = parse_timestamps([records[index]["created_at"] for index in missing])
+    return epochs
+
+
+# Format epochs as UTC 'YYYY-MM-DD' dates and 'HH:MM:SS' times, None for NAT
+def format_epochs(epochs: np.ndarray):
+    formatted = np.datetime_as_string(epochs.astype("datetime64[ms]"), unit="s").tolist()
+    dates = [None if value == "NaT" else value[:10] for value in formatted]
+    times = [None if value == "NaT" else value[11:] for value in formatted]
+    return dates, times
+
+
+def epoch_to_iso(epoch: int):
+    return datetime.fromtimestamp(epoch / 1000, timezone.utc).isoformat()
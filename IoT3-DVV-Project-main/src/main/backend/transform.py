@@ -1,107 +1,216 @@
-import datetime
-import json
+import config
+import metrics
+from calibration import CalibrationPlan, scale_frame
+from downsample import downsample_frame
+from frames import RecordFrame, column_values, created_at_values, reverse_frame
+from thresholds import ThresholdPlan, evaluate_frame
+from timestamps import format_epochs
 
 
-# Load units configuration from a JSON file
-def load_units_config(config_path="units.json"):
-    try:
-        with open(config_path, "r") as file:
-            return json.load(file)
-    except Exception as e:
-        print(f"Error loading units configuration: {e}")
-        return {}
+# Sum of the per-phase KW columns, counting missing values as 0
+def total_kw(frame: RecordFrame):
+    phases = [[0 if value is None else value for value in column_values(frame, key)] for key in ("KW_L1", "KW_L2", "KW_L3")]
+    return [l1 + l2 + l3 for l1, l2, l3 in zip(*phases)]
 
-def transform_data(extracted_data):
-    units_config = load_units_config()
-    transformed_records = []
-    for record in extracted_data:
-        properties = record.get("property", {})
-
-        # Extracting and transforming the timestamp
-        timestamp = record.get("created_at")
-        if timestamp:
-            dt = datetime.datetime.fromisoformat(timestamp.replace("Z", "+00:00"))
-            date = dt.date().isoformat()  # YYYY-MM-DD format
-            time = dt.strftime("%H:%M:%S")  # HH:MM:SS format without milliseconds
-        else:
-            date = None
-            time = None
 
+# Transform a calibrated record frame into one record per row. units defaults to the
+# units of the current configuration snapshot.
+@metrics.timed("transform")
+def transform_data(frame: RecordFrame, units: dict = None):
+    units = units or config.current().units
+    transformed_records = []
+    # YYYY-MM-DD dates and HH:MM:SS times (without milliseconds) of all records at once
+    dates, times = format_epochs(frame.epochs)
+    # Each property is read out of the frame once, as a list
+    columns = {key: column_values(frame, key) for key in COLUMNAR_FIELDS.values()}
+    rows = zip(dates, times, created_at_values(frame), total_kw(frame))
+    for index, (date, time, timestamp, total) in enumerate(rows):
         transformed_record = {
             "date": date,
             "time": time,
             "timestamp": timestamp,
             "voltage": {
-                "V1": properties.get("V1_Voltage"),
-                "V2": properties.get("V2_Voltage"),
-                "V3": properties.get("V3_Voltage"),
-                "unit": units_config.get("voltage", "Volts")  # Load unit from config
+                "V1": columns["V1_Voltage"][index],
+                "V2": columns["V2_Voltage"][index],
+                "V3": columns["V3_Voltage"][index],
+                "unit": units["voltage"]
             },
             "current": {
-                "I1": properties.get("I1_Current"),
-                "I2": properties.get("I2_Current"),
-                "I3": properties.get("I3_Current"),
-                "unit": units_config.get("current", "Ampere")  # Load unit from config
+                "I1": columns["I1_Current"][index],
+                "I2": columns["I2_Current"][index],
+                "I3": columns["I3_Current"][index],
+                "unit": units["current"]
             },
             "power": {
                 "KW": {
-                    "L1": properties.get("KW_L1"),
-                    "L2": properties.get("KW_L2"),
-                    "L3": properties.get("KW_L3"),
-                    "unit": units_config.get("power", {}).get("KW", "kW")  # Load unit from config
+                    "L1": columns["KW_L1"][index],
+                    "L2": columns["KW_L2"][index],
+                    "L3": columns["KW_L3"][index],
+                    "unit": units["power"]["KW"]
                 },
                 "Kvar": {
-                    "L1": properties.get("Kvar_L1"),
-                    "L2": properties.get("Kvar_L2"),
-                    "L3": properties.get("Kvar_L3"),
-                    "unit": units_config.get("power", {}).get("Kvar", "kVar")  # Load unit from config
+                    "L1": columns["Kvar_L1"][index],
+                    "L2": columns["Kvar_L2"][index],
+                    "L3": columns["Kvar_L3"][index],
+                    "unit": units["power"]["Kvar"]
                 },
                 "KVA": {
-                    "L1": properties.get("KVA_L1"),
-                    "L2": properties.get("KVA_L2"),
-                    "L3": properties.get("KVA_L3"),
-                    "unit": units_config.get("power", {}).get("KVA", "kVA")  # Load unit from config
+                    "L1": columns["KVA_L1"][index],
+                    "L2": columns["KVA_L2"][index],
+                    "L3": columns["KVA_L3"][index],
+                    "unit": units["power"]["KVA"]
                 },
                 "PF": {
-                    "L1": properties.get("PF_L1"),
-                    "L2": properties.get("PF_L2"),
-                    "L3": properties.get("PF_L3"),  # Corrected to PF_L3
-                    "unit": units_config.get("power", {}).get("PF", "%")  # Load unit from config
+                    "L1": columns["PF_L1"][index],
+                    "L2": columns["PF_L2"][index],
+                    "L3": columns["PF_L3"][index],  # Corrected to PF_L3
+                    "unit": units["power"]["PF"]
                 },
                 "Total": {
-                    "Kvar": properties.get("Total_Kvar"),
-                    "KVA": properties.get("Total_KVA"),
-                    "PF": properties.get("Total_PF"),
-                    "KW": (
-                        properties.get("KW_L1", 0) +
-                        properties.get("KW_L2", 0) +
-                        properties.get("KW_L3", 0)
-                    )
+                    "Kvar": columns["Total_Kvar"][index],
+                    "KVA": columns["Total_KVA"][index],
+                    "PF": columns["Total_PF"][index],
+                    "KW": total
                 }
             },
             "energy": {
-                "KwhImport": properties.get("Kwh_Import"),
-                "KVAhImport": properties.get("KVAh_import"),
-                "unit": units_config.get("energy", "kWh")  # Load unit from config
+                "KwhImport": columns["Kwh_Import"][index],
+                "KVAhImport": columns["KVAh_import"][index],
+                "unit": units["energy"]
             },
             "network": {
-                "act": properties.get("act"),
-                "rssi": properties.get("rssi"),
-                "wwanIp": properties.get("wwan_ip"),
-                "rsrp": properties.get("rsrp"),
-                "rsrq": properties.get("rsrq"),
+                "act": columns["act"][index],
+                "rssi": columns["rssi"][index],
+                "wwanIp": columns["wwan_ip"][index],
+                "rsrp": columns["rsrp"][index],
+                "rsrq": columns["rsrq"][index],
                 "lte": {
-                    "rx": properties.get("lte_rx"),
-                    "tx": properties.get("lte_tx"),
-                    "bytes": properties.get("lte_bytes")
+                    "rx": columns["lte_rx"][index],
+                    "tx": columns["lte_tx"][index],
+                    "bytes": columns["lte_bytes"][index]
                 },
                 "Frequency": {
-                    "Freq": properties.get("Frequency"),
-                    "unit": units_config.get("frequency", "Hz")  # Load unit from config
+                    "Freq": columns["Frequency"][index],
+                    "unit": units["frequency"]
                 }
             }
         }
 
         transformed_records.append(transformed_record)
 
-    return transformed_records
\ No newline at end of file
+    return transformed_records
+
+# Columnar layout: the path of each series in the response and the property it is read from
+COLUMNAR_FIELDS = {
+    ("voltage", "V1"): "V1_Voltage",
+    ("voltage", "V2"): "V2_Voltage",
+    ("voltage", "V3"): "V3_Voltage",
+    ("current", "I1"): "I1_Current",
+    ("current", "I2"): "I2_Current",
+    ("current", "I3"): "I3_Current",
+    ("power", "KW", "L1"): "KW_L1",
+    ("power", "KW", "L2"): "KW_L2",
+    ("power", "KW", "L3"): "KW_L3",
+    ("power", "Kvar", "L1"): "Kvar_L1",
+    ("power", "Kvar", "L2"): "Kvar_L2",
+    ("power", "Kvar", "L3"): "Kvar_L3",
+    ("power", "KVA", "L1"): "KVA_L1",
+    ("power", "KVA", "L2"): "KVA_L2",
+    ("power", "KVA", "L3"): "KVA_L3",
+    ("power", "PF", "L1"): "PF_L1",
+    ("power", "PF", "L2"): "PF_L2",
+    ("power", "PF", "L3"): "PF_L3",
+    ("power", "Total", "Kvar"): "Total_Kvar",
+    ("power", "Total", "KVA"): "Total_KVA",
+    ("power", "Total", "PF"): "Total_PF",
+    ("energy", "KwhImport"): "Kwh_Import",
+    ("energy", "KVAhImport"): "KVAh_import",
+    ("network", "act"): "act",
+    ("network", "rssi"): "rssi",
+    ("network", "wwanIp"): "wwan_ip",
+    ("network", "rsrp"): "rsrp",
+    ("network", "rsrq"): "rsrq",
+    ("network", "lte", "rx"): "lte_rx",
+    ("network", "lte", "tx"): "lte_tx",
+    ("network", "lte", "bytes"): "lte_bytes",
+    ("network", "Frequency"): "Frequency",
+}
+
+
+# Transform a calibrated record frame (newest first) into one array per series, in
+# chronological order, with the units given once in a header. Timestamps are the
+# created_at strings, or epoch milliseconds with epoch_timestamps.
+@metrics.timed("transform")
+def transform_columnar(frame: RecordFrame, epoch_timestamps: bool = False, units: dict = None):
+    frame = reverse_frame(frame)
+    dates, times = format_epochs(frame.epochs)
+
+    columns = {
+        "units": units or config.current().units,
+        "date": dates,
+        "time": times,
+        "timestamp": [
+            None if date is None else epoch for epoch, date in zip(frame.epochs.tolist(), dates)
+        ] if epoch_timestamps else created_at_values(frame),
+    }
+
+    for path, key in COLUMNAR_FIELDS.items():
+        parent = columns
+        for name in path[:-1]:
+            parent = parent.setdefault(name, {})
+        parent[path[-1]] = column_values(frame, key)
+
+    columns["power"]["Total"]["KW"] = total_kw(frame)
+
+    return columns
+
+
+# Calibrate a record frame, evaluate the thresholds on it and transform it, downsampled
+# if a point budget or resolution was requested. This is the CPU-bound part of a
+# /fetch-and-transform response, run through workers.run.
+def transform_frame(
+        frame: RecordFrame,
+        plan: CalibrationPlan,
+        threshold_plan: ThresholdPlan,
+        units: dict,
+        max_points: int,
+        resolution: int,
+        downsample: str,
+        minmax_channels: tuple,
+        columnar: bool,
+        epoch_timestamps: bool,
+        alerts: bool = True
+):
+    # Scale the values of all records in one batched pass; the shared frame is not modified
+    frame = scale_frame(plan, frame)
+
+    # Evaluate the thresholds on the full-resolution scaled data, unless not wanted
+    violations = None
+    if alerts:
+        with metrics.stage("alerts"):
+            violations = evaluate_frame(threshold_plan, frame)
+
+    # Downsample the scaled data if a point budget or resolution was requested
+    with metrics.stage("downsample"):
+        frame, downsampling = downsample_frame(frame, max_points, resolution, downsample, minmax_channels)
+
+    # Transform the scaled data
+    if columnar:
+        transformed_data = transform_columnar(frame, epoch_timestamps, units)
+    else:
+        transformed_data = transform_data(frame, units)
+
+    return {"mapped_data": transformed_data, "downsampling": downsampling, "alerts": violations}
+
+
+# Flatten a columnar response into named columns ("voltage.V1", ...) for binary encodings
+def flatten_columns(columns: dict, prefix: str = ""):
+    flat = {}
+    for name, value in columns.items():
+        if name == "units":
+            continue
+        if isinstance(value, dict):
+            flat.update(flatten_columns(value, f"{prefix}{name}."))
+        else:
+            flat[f"{prefix}{name}"] = value
+    return flat
@@ -0,0 +1,74 @@
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import asyncio
+import multiprocessing
+import os
+import metrics
+
+# Process pool for the CPU-bound work of a request: reading and calibrating the records,
+# evaluating thresholds, downsampling, transforming, encoding responses and formatting
+# exports (Parquet and Arrow files included).
+#
+# With CPU_WORKERS > 0 this work runs in that many processes, so one large request no
+# longer holds up the event loop for every other request, and the work of concurrent
+# requests runs on several cores. Jobs take and return picklable values (record frames,
+# plans, lists, dicts and encoded responses). The stage durations a job records are sent back and recorded
+# in this process, so they still show up in /metrics and Server-Timing. With
+# CPU_WORKERS=0 (the default) jobs run inline on the event loop.
+
+CPU_WORKERS = int(os.getenv("CPU_WORKERS", "0"))
+
+_pool = None
+
+
+def start_pool():
+    global _pool
+    if CPU_WORKERS > 0 and _pool is None:
+        # Fresh processes rather than forks, which would share the parent's store connection
+        _pool = ProcessPoolExecutor(max_workers=CPU_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        # Start the processes (and their imports) now rather than on the first request
+        for _ in range(CPU_WORKERS):
+            _pool.submit(os.getpid)
+
+
+def stop_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(cancel_futures=True)
+        _pool = None
+
+
+# Runs in a pool process: call the job and return its result with its stage durations
+def run_job(function, args: tuple):
+    timings = metrics.track_request()
+    return function(*args), timings
+
+
+# Replace a pool that broke because one of its processes died (e.g. killed for using too
+# much memory); every later job would fail on it. Jobs that broke along with it restart
+# it only once.
+def restart_pool(broken: ProcessPoolExecutor):
+    global _pool
+    if _pool is broken:
+        print("A CPU worker process died, restarting the pool")
+        broken.shutdown(wait=False, cancel_futures=True)
+        _pool = None
+        start_pool()
+
+
+# Run function(*args) in the pool, or inline without one. A job whose pool broke is
+# retried once on a new pool.
+async def run(function, *args):
+    if _pool is None:
+        return function(*args)
+
+    pool = _pool
+    loop = asyncio.get_running_loop()
+    try:
+        result, timings = await loop.run_in_executor(pool, run_job, function, args)
+    except BrokenProcessPool:
+        restart_pool(pool)
+        result, timings = await loop.run_in_executor(_pool, run_job, function, args)
+    for name, seconds in timings.items():
+        metrics.record_stage(name, seconds)
+    return result
@@ -38,8 +38,8 @@ const PollingDropdown = ({ onIntervalChange, isToday }) => {
         <option value="30">30 sec</option>
         <option value="60">1 min</option>
         <option value="120">2 min</option>
-        <option value="3000">5 min</option>
-        <option value="6000">10 min</option>
+        <option value="300">5 min</option>
+        <option value="600">10 min</option>
       </select>
 
       {/* ChevronDown icon to indicate dropdown direction, with conditional styling */}
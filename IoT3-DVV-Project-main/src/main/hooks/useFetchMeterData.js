@@ -6,12 +6,20 @@ import { useRecoilValue, useSetRecoilState } from 'recoil';
 import { shouldFetchDataState, dateRangeState, meterDataState } from '../lib/atoms';
 
 // Import utility function to map API data to the graph structure
-import { mapDataToGraphStructure } from '../utils/meterDataMapper';
+import { mapColumnarDataToGraphStructure, appendColumnarData } from '../utils/meterDataMapper';
+
+// Upper bound on points per series; longer ranges are downsampled by the backend. The
+// charts draw one line per series, so LTTB keeps the visually significant records
+// instead of returning bucket means plus min/max envelopes that are never drawn.
+const MAX_CHART_POINTS = 5000;
+// Points requested per series; the rest of MAX_CHART_POINTS is left for live updates,
+// after which the range is fetched (and downsampled) again
+const FETCH_CHART_POINTS = Math.floor(MAX_CHART_POINTS * 0.8);
 
 /**
  * Custom hook: useFetchMeterData
  * Fetches meter data based on selected meter and date range.
- * Includes polling logic for real-time updates when pollingInterval is provided.
+ * Subscribes to live updates from the backend when pollingInterval is provided.
  */
 // [MYA010] Custom hook to fetch meter data based on selected meter and date range
 const useFetchMeterData = (selectedMeter, pollingInterval) => {
@@ -26,9 +34,11 @@ const useFetchMeterData = (selectedMeter, pollingInterval) => {
   const data = useRecoilValue(meterDataState); // Current meter data
 
   // Refs to manage state and avoid unnecessary re-renders
-  const pollingIntervalRef = useRef(pollingInterval); // Ref for polling interval
   const fetchInProgressRef = useRef(false); // Prevent overlapping fetches
 
+  // Epoch milliseconds of the newest record of the last fetch; live updates start after it
+  const [liveSince, setLiveSince] = useState(null);
+
   // Utility function: Get today's date in ISO format (YYYY-MM-DD)
   const getToday = () => {
     const today = new Date();
@@ -42,10 +52,11 @@ const useFetchMeterData = (selectedMeter, pollingInterval) => {
 
     fetchInProgressRef.current = true; // Mark fetch as in progress
     setLoading(true); // Set loading state
+    setLiveSince(null); // Resubscribe once the fetched data is shown
 
     try {
        // [MYA024] Constructing the API URL with the device serial number, date range, and max pages
-      const url = `http://localhost:8000/fetch-and-transform?device_serial_number=${selectedMeter}&start_date=${dateRange.startDate}&end_date=${dateRange.endDate}&max_pages=1000`;
+      const url = `http://localhost:8000/fetch-and-transform?device_serial_number=${selectedMeter}&start_date=${dateRange.startDate}&end_date=${dateRange.endDate}&max_pages=1000&max_points=${FETCH_CHART_POINTS}&downsample=lttb&format=columnar`;
 
       // Make API call
       const response = await fetch(url);
@@ -55,12 +66,12 @@ const useFetchMeterData = (selectedMeter, pollingInterval) => {
 
       // Parse response data
       const result = await response.json();
-      if (!result.mapped_data || !Array.isArray(result.mapped_data)) {
+      if (!result.mapped_data || !Array.isArray(result.mapped_data.timestamp)) {
         throw new Error('Invalid data format received from API');
       }
 
-      // Map raw data to graph structure
-      const structuredData = mapDataToGraphStructure(result);
+      // Map the columnar series to the graph structure
+      const structuredData = mapColumnarDataToGraphStructure(result);
 
       // Validate mapped data structure
       if (!structuredData.mappedData || !structuredData.mappedData.timestamps) {
@@ -69,6 +80,9 @@ const useFetchMeterData = (selectedMeter, pollingInterval) => {
 
       // Update global meter data state
       setMeterData(structuredData);
+
+      const timestamps = structuredData.mappedData.timestamps;
+      setLiveSince(timestamps.length ? Date.parse(timestamps[timestamps.length - 1]) : Date.now());
     } catch (err) {
       console.error('Error fetching data:', err);
       setError(err); // Set error state
@@ -85,41 +99,52 @@ const useFetchMeterData = (selectedMeter, pollingInterval) => {
     }
   }, [selectedMeter, dateRange, shouldFetchData, fetchData]);
 
-  // Effect: Polling logic for periodic updates
+  // Effect: Live updates for today's data. The backend polls the meter every
+  // pollingInterval seconds, once for all viewers, and pushes only the records newer
+  // than the fetched data as Server-Sent Events. The subscription is opened once a
+  // fetch has completed, so that it starts right after the data shown.
   useEffect(() => {
-    let timeoutId; // ID for clearing timeout
-
-    // Update ref when pollingInterval changes
-    pollingIntervalRef.current = pollingInterval;
+    // Subscribe only if live updates are enabled and the date range ends today
+    if (pollingInterval === null || !selectedMeter || dateRange.endDate !== getToday() || liveSince === null) {
+      return undefined;
+    }
 
-    // Polling function
-    const pollData = async () => {
-      // Exit polling if date range is not today or no interval is set
-      if (dateRange.endDate !== getToday() || !pollingIntervalRef.current) {
-        return;
-      }
+    const source = new EventSource(
+      `http://localhost:8000/subscribe?device_serial_number=${selectedMeter}&interval=${pollingInterval}&since=${liveSince}`
+    );
 
+    // Append the new records to the data already shown
+    source.addEventListener('delta', (event) => {
       try {
-        // Fetch data
-        await fetchData();
+        const delta = JSON.parse(event.data);
+        setMeterData((previous) =>
+          previous && previous.mappedData ? appendColumnarData(previous, delta) : previous
+        );
       } catch (err) {
-        console.error('Error during polling:', err);
-      } finally {
-        // Schedule next poll if conditions are met
-        if (pollingIntervalRef.current && dateRange.endDate === getToday()) {
-          timeoutId = setTimeout(pollData, pollingIntervalRef.current * 1000);
-        }
+        console.error('Error applying live update:', err);
       }
+    });
+
+    // The subscription fell behind; reload the full range
+    source.addEventListener('resync', () => {
+      fetchData();
+    });
+
+    source.onerror = (err) => {
+      console.error('Live update connection error:', err);
     };
 
-    // Start polling if conditions are met
-    if (pollingInterval !== null && dateRange.endDate === getToday()) {
-      pollData();
-    }
+    // Cleanup: Close the subscription on component unmount or dependency change
+    return () => source.close();
+  }, [pollingInterval, dateRange, selectedMeter, liveSince, fetchData, setMeterData]);
 
-    // Cleanup: Clear timeout on component unmount or dependency change
-    return () => clearTimeout(timeoutId);
-  }, [pollingInterval, dateRange, selectedMeter, fetchData]);
+  // Effect: Once live updates have grown the series past MAX_CHART_POINTS, fetch the
+  // range again so that it is downsampled as a whole
+  useEffect(() => {
+    if (pollingInterval !== null && data?.mappedData?.timestamps?.length > MAX_CHART_POINTS) {
+      fetchData();
+    }
+  }, [data, pollingInterval, fetchData]);
 
   // Return data, loading state, and error state
   return { data, loading, error };
@@ -164,4 +164,90 @@ export const mapDataToGraphStructure = (response) => {
   structuredData.mappedData.network.Frequency1.reverse();
 
   return structuredData;
-};
\ No newline at end of file
+};
+
+// Maps a `format=columnar` response, where mapped_data already holds one array per
+// series in chronological order and the units are given once in a header
+export const mapColumnarDataToGraphStructure = (response) => {
+  const columns = response.mapped_data;
+  const units = columns.units;
+
+  return {
+    deviceInfo: { ...response.device_info },
+    thresholdValues: {
+      voltage: response.threshold_values.voltage,
+      current: response.threshold_values.current,
+      power: response.threshold_values.power,
+      Frequency: response.threshold_values.Frequency,
+    },
+    mappedData: {
+      date: columns.date,
+      time: columns.time,
+      timestamps: columns.timestamp,
+      voltage: { ...columns.voltage, unit: units.voltage },
+      current: { ...columns.current, unit: units.current },
+      power: {
+        KW: { ...columns.power.KW, unit: units.power.KW },
+        Kvar: { ...columns.power.Kvar, unit: units.power.Kvar },
+        KVA: { ...columns.power.KVA, unit: units.power.KVA },
+        PF: { ...columns.power.PF, unit: units.power.PF },
+        Total: {
+          KW1: columns.power.Total.KW,
+          Kvar: columns.power.Total.Kvar,
+          KVA: columns.power.Total.KVA,
+          PF: columns.power.Total.PF,
+          unit: units.power.KW,
+        },
+      },
+      energy: { ...columns.energy, unit: units.energy },
+      network: {
+        act: columns.network.act,
+        rssi: columns.network.rssi,
+        rsrp: columns.network.rsrp,
+        rsrq: columns.network.rsrq,
+        Frequency1: columns.network.Frequency,
+        units: {
+          Frequency: units.frequency,
+        },
+      },
+    },
+  };
+};
+
+// Appends every series of `added`, from index `skip` on, to the matching series of
+// `current`, keeping units
+const appendSeries = (current, added, skip) => {
+  if (Array.isArray(current)) {
+    return Array.isArray(added) ? current.concat(added.slice(skip)) : current;
+  }
+  if (current && typeof current === 'object') {
+    return Object.fromEntries(
+      Object.entries(current).map(([key, value]) => [key, appendSeries(value, added?.[key], skip)])
+    );
+  }
+  return current;
+};
+
+// Appends a live delta from /subscribe (device_info plus new records in the columnar
+// format) to graph data built by mapColumnarDataToGraphStructure. Points at or before
+// the last timestamp already shown are dropped, so a delta overlapping the data (e.g.
+// after a refetch) is not appended twice.
+export const appendColumnarData = (meterData, delta) => {
+  const added = mapColumnarDataToGraphStructure({
+    ...delta,
+    threshold_values: meterData.thresholdValues,
+  });
+
+  const timestamps = meterData.mappedData.timestamps;
+  const last = timestamps.length ? Date.parse(timestamps[timestamps.length - 1]) : -Infinity;
+  const skip = added.mappedData.timestamps.findIndex((timestamp) => Date.parse(timestamp) > last);
+  if (skip === -1) {
+    return { ...meterData, deviceInfo: added.deviceInfo };
+  }
+
+  return {
+    ...meterData,
+    deviceInfo: added.deviceInfo,
+    mappedData: appendSeries(meterData.mappedData, added.mappedData, skip),
+  };
+};